@@ -1,13 +1,13 @@
 '''
 This module provides tools for caching the results of function calls.
-Currently, it is primarily intended for use by the Sweep module.
-
-ToDo:
-Implement a straighforward memoization decorator for functions which acts a simple interface for sweep.
+It is primarily intended for use by the Sweep module, while `memoize` provides a straightforward decorator for caching individual functions.
 '''
-import inspect, os, pickle, sys
+import hashlib, inspect, os, pickle, sys, threading
+from collections import OrderedDict
+from functools import lru_cache, partial, wraps
 
-from .Filesystem import filename_without_extension
+from .Filesystem import filename_without_extension, write_atomic
+from . import Serialization
 from .Dict import hash384
 
 def get_caller():
@@ -57,43 +57,64 @@ def signature_string(f=None, locals=None, **kw):
     if locals is None:
         locals = get_caller_locals()
 
-    locals = {**locals, **kw}
+    return signature_formatter(f)({**locals, **kw})
 
-    sig = inspect.signature(f)
 
-    args, kws = signature_lists(f)
+@lru_cache(maxsize=1024)
+def signature_formatter(f):
+    '''Returns a function `format(locals)` that produces the same strings as `signature_string(f=f, locals=locals)`.
 
-    arg_strs = [str(locals[p]) for p in args]
+    The signature of `f` is only inspected once (and the formatter is memoized), so this is the preferred way to render the signatures
+    of many calls to the same function. The formatter also has a `many(pars, kws)` method, which renders the signatures of a batch of 
+    calls given an Iterable of positional argument tuples `pars` and an Iterable of keyword dicts `kws`, as well as the `args` and `kws`
+    lists returned by `signature_lists(f)`.
+    '''
+    sig = inspect.signature(f)
 
-    kw_strs = []
+    args, kws = signature_lists(f)
 
+    # (name, default, string used when the value differs from a bool default) for each keyword
+    flags = []
     for p in kws:
-        if p in locals.keys():
-            val = locals[p]
-            default = sig.parameters[p].default
-            if default != val:
-                if not isinstance(default, bool):
-                    kw_strs.append(p+'='+str(locals[p]))
-                elif default == True:
-                    kw_strs.append('no_'+p)
-                else:
-                    kw_strs.append(p)
-
-    out = ''
-
-    if len(kw_strs):
-        out += '_'.join(kw_strs)
-
-    if len(arg_strs):
-        new = ','.join(arg_strs)
-        if len(out):
-            out += '_'+new
+        default = sig.parameters[p].default
+        if not isinstance(default, bool):
+            flags.append((p, default, None))
+        elif default == True:
+            flags.append((p, default, 'no_'+p))
         else:
-            out = new
-    elif len(out) == 0:
-        out = '_'
+            flags.append((p, default, p))
+
+    def format(locals):
+        arg_strs = [str(locals[p]) for p in args]
+
+        kw_strs = []
+        for p, default, flag in flags:
+            if p in locals:
+                val = locals[p]
+                if default != val:
+                    kw_strs.append(p+'='+str(val) if flag is None else flag)
+
+        out = '_'.join(kw_strs)
+
+        if len(arg_strs):
+            new = ','.join(arg_strs)
+            if len(out):
+                out += '_'+new
+            else:
+                out = new
+        elif len(out) == 0:
+            out = '_'
+
+        return out
 
-    return out
+    def many(pars, kws):
+        return [format({**dict(zip(args, p)), **k}) for p, k in zip(pars, kws)]
+
+    format.many = many
+    format.args = args
+    format.kws = kws
+
+    return format
 
 
 def signature_lists(f):
@@ -119,25 +140,128 @@ def function_savedir(func):
     return os.path.join(filename, funcname)
 
 
-def cache_file(func=None, locals=None, cache_dir='.', filename=None, **kw):
+def function_hash(func, deps=()):
+    '''
+    sha384 hash (see `Dict.hash384`) of the implementation of a function, for content-addressed caching.
+
+    The hash covers the bytecode, constants and names of `func` (including any nested functions), its default values, and the values 
+    in its closure. Changing the body of `func` therefore changes its hash, while moving it around in its file does not. Other functions 
+    or modules that `func` depends on are only included if listed in `deps`, functions by their implementation and modules by the 
+    contents of their source file. Other values are described by their repr, or by their attributes if the repr is just a memory address. 
+    A TypeError is raised for values that cannot be described deterministically. Note that bytecode differs between python versions.
+    '''
+    tokens = _value_tokens(func)
+
+    for dep in deps:
+        if inspect.ismodule(dep) and getattr(dep, '__file__', None):
+            with open(dep.__file__, 'rb') as file:
+                tokens.append(hashlib.sha384(file.read()).hexdigest())
+        else:
+            tokens.extend(_value_tokens(dep))
+
+    return hash384(tokens)
+
+def _code_tokens(code):
+    '''deterministic strings describing a code object, ignoring line numbers'''
+    tokens = [code.co_code.hex(), repr(code.co_names), repr(code.co_varnames), repr(code.co_freevars)]
+    for c in code.co_consts:
+        if inspect.iscode(c):
+            tokens.extend(_code_tokens(c))
+        elif isinstance(c, frozenset): # iteration order of sets varies between runs
+            tokens.append(repr(sorted(map(repr, c))))
+        else:
+            tokens.append(repr(c))
+    return tokens
+
+def _value_tokens(value, path=None):
+    '''
+    deterministic strings describing a value, functions are described by their implementation. `path` holds the ids of the values 
+    being described further up, a value that refers back to one of them (e.g., a recursive function) is described by how far up it is
+    '''
+    if path is None:
+        path = []
+    if id(value) in path:
+        return [f'<cycle {len(path) - path.index(id(value))}>']
+
+    path.append(id(value))
+    try:
+        return _describe(value, lambda v: _value_tokens(v, path))
+    finally:
+        path.pop()
+
+def _describe(value, tokens_of):
+    '''the tokens of `_value_tokens`, with `tokens_of` describing the values that `value` refers to'''
+    code = getattr(value, '__code__', None)
+    if code is not None:
+        tokens = _code_tokens(code)
+        tokens.extend(t for v in value.__defaults__ or () for t in tokens_of(v))
+        tokens.extend(tokens_of(value.__kwdefaults__ or {}))
+        for cell in value.__closure__ or ():
+            try:
+                contents = cell.cell_contents
+            except ValueError: # empty cell
+                tokens.append('<empty>')
+            else:
+                tokens.extend(tokens_of(contents))
+        return tokens
+    elif isinstance(value, (list, tuple)): # the length keeps e.g. ([1, 2], [3]) and ([1], [2, 3]) apart
+        return [type(value).__name__, str(len(value)), *[t for v in value for t in tokens_of(v)]]
+    elif isinstance(value, dict):
+        return [t for k in sorted(value, key=repr) for t in (repr(k), *tokens_of(value[k]))]
+    elif isinstance(value, (set, frozenset)): # iteration order of sets varies between runs
+        return [type(value).__name__, *sorted(repr(tokens_of(v)) for v in value)]
+    elif getattr(value, 'dtype', None) == object and hasattr(value, 'tolist'): # the bytes of object arrays are pointers
+        return ['object', repr(getattr(value, 'shape', ())), *tokens_of(value.tolist())]
+    elif hasattr(value, 'tobytes') and hasattr(value, 'dtype'): # numpy arrays, whose repr is truncated
+        return [str(value.dtype), repr(getattr(value, 'shape', ())), hashlib.sha384(value.tobytes()).hexdigest()]
+    elif isinstance(value, partial):
+        return ['partial', *tokens_of(value.func), *tokens_of(value.args), *tokens_of(value.keywords)]
+    elif inspect.ismodule(value):
+        return [value.__name__]
+    elif isinstance(value, type):
+        return [f'{value.__module__}.{value.__qualname__}']
+
+    text = repr(value)
+    if ' at 0x' not in text:
+        return [text]
+
+    #the default repr of an object is its memory address, which differs between runs
+    name = f'{type(value).__module__}.{type(value).__qualname__}'
+    if hasattr(value, '__dict__'):
+        return [name, *tokens_of(vars(value))]
+    try:
+        return [name, hashlib.sha384(pickle.dumps(value, protocol=4)).hexdigest()]
+    except Exception as e:
+        raise TypeError(f'cannot hash the {name} object {text} deterministically, give it a __repr__ or make it picklable') from e
+
+
+def cache_file(func=None, locals=None, cache_dir='.', filename=None, content_hash=False, extension='.pickle', **kw):
+    '''
+    Path of the cache file for a call to `func` (the calling function if `None`), see `signature_string`. If `content_hash` is True, 
+    the path also includes `function_hash(func)`, so that changing the implementation of `func` invalidates its cached results.
+    The `extension` selects the serializer of the cached result, see the `Serialization` module.
+    '''
     if func is None:
         func = get_caller()
 
     funcpath = function_savedir(func)
 
+    if content_hash:
+        funcpath = os.path.join(funcpath, function_hash(func)[:16])
+
     if filename is None:
         if locals is None:
             locals = get_caller_locals()
 
         sig = signature_string(f=func, locals=locals, **kw)
 
-        return os.path.join(cache_dir, funcpath, sig + '.pickle')
+        return os.path.join(cache_dir, funcpath, sig + extension)
     else:
         return os.path.join(cache_dir, funcpath, filename)
 
 
 
-def cached(func=None, locals=None,   cache_dir='.', **kw):
+def cached(func=None, locals=None,   cache_dir='.', content_hash=False, extension='.pickle', mmap=False, **kw):
     ''' returns the cached result of the current function, with any keyword replacements in **kw'''
 
 
@@ -149,25 +273,112 @@ def cached(func=None, locals=None,   cache_dir='.', **kw):
     if locals is None:
         locals = get_caller_locals()
 
-    path = cache_file(func=func, locals=locals, cache_dir=cache_dir, **kw)
+    path = cache_file(func=func, locals=locals, cache_dir=cache_dir, content_hash=content_hash, extension=extension, **kw)
 
     if os.path.exists(path):
-            with open(path, 'rb') as file:
-                return pickle.load(file)
+            return Serialization.load(path, mmap=mmap)
     else:
        return None
 
 def cached_call(_ , *arg,   cache_dir='.', **kw):
     ''' returns the cached result of a function call, if no cached result exists run the function and cache the result'''
+    sig = inspect.signature(_)
+    if all(p.kind not in (p.VAR_POSITIONAL, p.VAR_KEYWORD) for p in sig.parameters.values()):
+        #results stored under their signature string, e.g. by Sweep, are found too
+        path = cache_file(func=_, locals=sig.bind(*arg, **kw).arguments, cache_dir=cache_dir)
+        if os.path.exists(path):
+            return Serialization.load(path, mmap=False)
 
-    #need to somehow get the positional arg names of the function and map *arg onto those, probably can use the locals interface....
-    path = cache_file(func=_, locals={}, cache_dir=cache_dir, **kw)
+    return memoize(_, maxsize=0, cache_dir=cache_dir)(*arg, **kw)
 
-    if os.path.exists(path):
-            with open(path, 'rb') as file:
-                return pickle.load(file)
+
+def memoize(func=None, maxsize=128, max_bytes=None, cache_dir='.cache', disk=True, content_hash=False):
+    '''
+    Decorator that caches the results of a function in two tiers, a bounded in-memory LRU cache in front of on-disk pickles in `cache_dir`.
+    Results are keyed on the contents of the arguments (see `function_hash`), so e.g. arrays that only differ deep inside are told apart.
+    Can be used as `@memoize` or with keywords, e.g., `@memoize(maxsize=16, disk=False)`.
+
+    Kwargs:
+        maxsize : maximum number of results kept in memory, `None` for no limit and 0 to only use the disk. Default is 128.
+        max_bytes : maximum (approximate) total size in bytes of the results kept in memory, `None` (default) for no limit.
+        cache_dir : base directory of the on-disk cache, see `cache_file`. Default is '.cache'.
+        disk : whether results are also stored on/retrieved from disk. Default is `True`.
+        content_hash : key the on-disk cache on the implementation of the function as well, see `function_hash`. Default is `False`.
+
+    Returns:
+        The decorated function, which has a `cache_info()` method returning a dict of hit/miss statistics and a `cache_clear()` method for 
+        emptying the in-memory cache. Disk writes are atomic, so the same cache can safely be shared by threads and processes.
+    '''
+    if func is None:
+        return lambda f: memoize(f, maxsize=maxsize, max_bytes=max_bytes, cache_dir=cache_dir, disk=disk, content_hash=content_hash)
+
+    sig = inspect.signature(func)
+    if content_hash:
+        funcdir = os.path.join(cache_dir, function_savedir(func), function_hash(func)[:16])
     else:
-       return None
+        funcdir = os.path.join(cache_dir, function_savedir(func))
+
+    memory = OrderedDict() # key -> (result, size)
+    lock = threading.Lock()
+    stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'size': 0, 'bytes': 0}
+
+    def remember(key, result, size):
+        if maxsize == 0 or (max_bytes is not None and size > max_bytes):
+            return
+        with lock:
+            if key in memory:
+                stats['bytes'] -= memory.pop(key)[1]
+            memory[key] = (result, size)
+            stats['bytes'] += size
+            while (maxsize is not None and len(memory) > maxsize) or (max_bytes is not None and stats['bytes'] > max_bytes):
+                stats['bytes'] -= memory.popitem(last=False)[1][1]
+            stats['size'] = len(memory)
+
+    @wraps(func)
+    def memoized(*args, **kw):
+        #keyed on the contents of the arguments rather than their (possibly truncated) strings, with defaults and empty *args/**kw filled in
+        bound = sig.bind(*args, **kw)
+        bound.apply_defaults()
+        key = hash384(_value_tokens(dict(bound.arguments)))
+
+        with lock:
+            if key in memory:
+                memory.move_to_end(key)
+                stats['hits'] += 1
+                return memory[key][0]
+
+        path = os.path.join(funcdir, key + '.pickle')
+        if disk and os.path.exists(path):
+            with open(path, 'rb') as file:
+                data = file.read()
+            result = pickle.loads(data)
+            with lock:
+                stats['disk_hits'] += 1
+        else:
+            result = func(*args, **kw)
+            data = pickle.dumps(result) if disk or max_bytes is not None else None
+            if disk:
+                write_atomic(path, data)
+            with lock:
+                stats['misses'] += 1
+
+        remember(key, result, len(data) if data is not None else 0)
+
+        return result
+
+    def cache_info():
+        with lock:
+            return dict(stats)
+
+    def cache_clear():
+        with lock:
+            memory.clear()
+            stats['size'] = stats['bytes'] = 0
+
+    memoized.cache_info = cache_info
+    memoized.cache_clear = cache_clear
+
+    return memoized
 
 # def check_function_cache(func, load=True, kw={}, pre_hash=''):
 #     cache = os.path.join('.cache', function_savedir(func))
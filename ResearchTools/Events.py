@@ -22,15 +22,12 @@ def TimeBasedEventExecutor(events):
     Returns:
         wait_and_excute: Function that can be called with signature wait_and_execute(t, *args), where `t` is the current "time" and `*args` are any argument
             to be passed to the event function(s). This function also has `extend` and `append` methods that allow for the event list to be grown using the same
-            syntax as lists.
-
-    ToDo:
-        Add method to query the time until the next event.
+            syntax as lists, and a `next_time` method that returns the time of the next pending event (inf if there is none).
 
     '''
     def wait_and_execute(t, *args):
         fired=[]
-        for evt in events: #iterate over events list and execute any fired events
+        for evt in list(events): #iterate over a copy of the events list and execute any fired events, event functions may add new events
             if t >= evt[0]:
                 fired.append(evt)
                 evt[1](*args)
@@ -43,8 +40,10 @@ def TimeBasedEventExecutor(events):
         return len(fired)>0
 
     def sort():
-        nonlocal events
-        events=list(sorted(events, key=lambda x:x[0]))
+        events.sort(key=lambda x:x[0]) #in place, so that `out.events` stays the live list
+
+    def next_time():
+        return min((evt[0] for evt in events), default=float('inf'))
 
     def append(x):
         events.append(x)
@@ -57,6 +56,7 @@ def TimeBasedEventExecutor(events):
     out = wait_and_execute
     out.append = append
     out.extend = extend
+    out.next_time = next_time
     out.events = events
 
     return out
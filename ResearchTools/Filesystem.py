@@ -1,4 +1,4 @@
-import fnmatch, os, re
+import fnmatch, os, re, sqlite3, tempfile, threading
 import numpy as np
 
 def pattern_to_regex(pattern):
@@ -66,4 +66,47 @@ def filename_without_extension(path):
 def ensure_directory_exists(path):
     dir=os.path.dirname(path)
     if not os.path.exists(dir):
-        os.makedirs(dir)
\ No newline at end of file
+        os.makedirs(dir)
+
+def write_atomic(path, data):
+    '''Writes the bytes `data` to `path` through a temporary file that is renamed into place, so that readers (in any process) only ever see complete files.
+    `data` may also be a function that writes to the (binary) temporary file object it is given.'''
+    dir = os.path.dirname(path) or '.'
+    if not os.path.exists(dir):
+        os.makedirs(dir, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=dir, prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            if callable(data):
+                data(file)
+            else:
+                file.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+_sqlite_connections = {}
+
+def sqlite_connect(db, schema=()):
+    '''Returns a connection to the SQLite file `db` in autocommit mode (transactions are opened explicitly), creating the file, its directory, 
+    and the tables of `schema` (a tuple of SQL statements) if needed.
+
+    There is one connection per file, process and thread, as connections cannot be shared across a fork, pickled for a worker pool, 
+    or used by several threads at once (their transactions would nest). The rollback journal is used rather than WAL, since WAL needs
+    shared memory, which does not work across the hosts of a networked filesystem.'''
+    key = (db, schema, os.getpid(), threading.get_ident())
+    conn = _sqlite_connections.get(key)
+    if conn is None:
+        directory = os.path.dirname(db)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(db, timeout=600, isolation_level=None, check_same_thread=False) # thread ids are reused
+        conn.execute('PRAGMA journal_mode=DELETE')
+        for statement in schema:
+            conn.execute(statement)
+        _sqlite_connections[key] = conn
+    return conn
@@ -10,7 +10,10 @@
 ##########
 
 
-from numba import jit
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from numba import jit, prange
 
 from scipy.spatial import ConvexHull
 import numpy as np
@@ -49,16 +52,35 @@ def unit_vector_2D(A,B):
 def convex_hull_volume(pts):
     return ConvexHull(pts).volume
 
+def convex_hull_volumes(points, indptr=None, workers=None):
+    # volumes of the convex hulls of many point sets, either a sequence of (n_i,3) arrays, or given in CSR form: the points of set i are
+    # points[indptr[i]:indptr[i+1]]. The hulls are built on `workers` threads (qhull runs without holding the GIL)
+    if indptr is not None:
+        points = [points[indptr[i]:indptr[i+1]] for i in range(len(indptr)-1)]
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(points) < 2:
+        return np.array([convex_hull_volume(p) for p in points], dtype=float)
+
+    with ThreadPoolExecutor(workers) as executor:
+        return np.fromiter(executor.map(convex_hull_volume, points), dtype=float, count=len(points))
+
 
 @jit(nopython=True, cache=True, inline='always')
-def cross33(a,b):
-    # cross product between two 3-vectors
-    return np.array([a[1]*b[2]-a[2]*b[1], a[2]*b[0]-a[0]*b[2],a[0]*b[1]-a[1]*b[0]])
+def cross33(a,b,out=None):
+    # cross product between two 3-vectors, written into out if given (which must not alias a or b)
+    if out is None:
+        out = np.empty(3)
+    out[0]=a[1]*b[2]-a[2]*b[1]
+    out[1]=a[2]*b[0]-a[0]*b[2]
+    out[2]=a[0]*b[1]-a[1]*b[0]
+    return out
 
 @jit(nopython=True, cache=True, inline='always')
-def cross3Mat(a,b):
-    #cross product between a vector and an Nx3 matrix
-    out = np.zeros((b.shape))
+def cross3Mat(a,b,out=None):
+    #cross product between a vector and an Nx3 matrix, written into out if given
+    if out is None:
+        out = np.empty(b.shape)
     for i in range(0,b.shape[0]):
         out[i,0]=a[1]*b[i,2]-a[2]*b[i,1]
         out[i,1]=a[2]*b[i,0]-a[0]*b[i,2]
@@ -67,9 +89,10 @@ def cross3Mat(a,b):
     return out
 
 @jit(nopython=True, cache=True, inline='always')
-def crossMatMat(a,b):
-    # pair-wise cross products of two Nx3 matrices
-    out = np.zeros((b.shape))
+def crossMatMat(a,b,out=None):
+    # pair-wise cross products of two Nx3 matrices, written into out if given
+    if out is None:
+        out = np.empty(b.shape)
     for i in range(0,b.shape[0]):
         out[i,0]=a[i,1]*b[i,2]-a[i,2]*b[i,1]
         out[i,1]=a[i,2]*b[i,0]-a[i,0]*b[i,2]
@@ -80,53 +103,223 @@ def crossMatMat(a,b):
 
 
 def sort_corners(corners, center_pos, pos_nodes):
-
-    corn_sort = [(corners[0],0)]
-    u = unit_vector_2D(center_pos, pos_nodes[corners[0]])
-
-    for i in range(1,len(corners)):
-        v = unit_vector_2D(center_pos, pos_nodes[corners[i]])
-        dot = np.dot(u,v)
-        det = np.linalg.det([u,v])
-        angle = np.arctan2(det,dot)
-        corn_sort.append((corners[i],angle))
-        corn_sort = sorted(corn_sort, key=lambda x: x[1])
-        corn2 = [pos_nodes[entry[0]] for entry in corn_sort]
+    # sort the corners of a polygon by their (in-plane) angle around center_pos, relative to the first corner, in (-pi, pi]
+    # returns the sorted corner positions, and the sorted (corner, angle) pairs
+
+    # pos_nodes may be any mapping from corner labels to positions (e.g. a networkx pos dict), so gather the positions by label
+    d = np.array([pos_nodes[c] for c in corners])[:,:2] - np.asarray(center_pos)[:2]
+    u = d[0]
+    angles = np.arctan2(u[0]*d[:,1]-u[1]*d[:,0], u[0]*d[:,0]+u[1]*d[:,1])
+    angles[0] = 0
+    order = np.argsort(angles, kind='stable')
+
+    corn_sort = [(corners[i], angles[i]) for i in order]
+    corn2 = [pos_nodes[corners[i]] for i in order]
     
     return corn2, corn_sort
 
 @jit(nopython=True, cache=True, inline='always')
-def triangle_area_and_vector(pos_side):
+def triangle_area_and_vector(pos_side, out=None):
     
-    A_alpha = triangle_area_vector(pos_side)
-    return np.linalg.norm(A_alpha), A_alpha
+    A_alpha = triangle_area_vector(pos_side, out)
+    return np.sqrt(A_alpha[0]*A_alpha[0]+A_alpha[1]*A_alpha[1]+A_alpha[2]*A_alpha[2]), A_alpha
     
 
 @jit(nopython=True, cache=True, inline='always')
-def triangle_area_vector(pos_side):
-
-    inds=np.array([2,0,1])
-    A_alpha = np.sum(crossMatMat(pos_side,pos_side[inds]),axis=0)/2
-    return A_alpha
+def triangle_area_vector(pos_side, out=None):
+    # half the sum of the cross products of each corner with the previous one, accumulated in place (into out if given)
+    if out is None:
+        out = np.empty(3)
+    out[:] = 0.0
+    for i in range(3):
+        a, b = pos_side[i], pos_side[i-1]
+        out[0] += a[1]*b[2]-a[2]*b[1]
+        out[1] += a[2]*b[0]-a[0]*b[2]
+        out[2] += a[0]*b[1]-a[1]*b[0]
+    out /= 2
+    return out
 
 @jit(nopython=True, cache=True, inline='always')
-def triangle_areas_and_vectors(pos_side):
-
-    A_alpha = triangle_area_vectors(pos_side)
+def triangle_areas_and_vectors(pos_side, out_areas=None, out_vectors=None):
+    # area vectors and their norms of a (T,3,3) stack of triangles in a single pass
+    if out_areas is None:
+        out_areas = np.empty(pos_side.shape[0])
+
+    A_alpha = triangle_area_vectors(pos_side, out_vectors)
+    for t in range(pos_side.shape[0]):
+        out_areas[t] = np.sqrt(A_alpha[t,0]*A_alpha[t,0]+A_alpha[t,1]*A_alpha[t,1]+A_alpha[t,2]*A_alpha[t,2])
     
-    return np.array([np.linalg.norm(v) for v in A_alpha]), A_alpha
+    return out_areas, A_alpha
 
 @jit(nopython=True, cache=True, inline='always')
-def triangle_area_vectors(pos_side) -> np.ndarray:
+def triangle_area_vectors(pos_side, out=None) -> np.ndarray:
     
-    inds=np.array([2,0,1])
-    A_alpha = 0.5*np.sum(np.cross(pos_side,pos_side[:,inds,:]), axis=1)
+    if out is None:
+        out = np.empty((pos_side.shape[0], 3))
+    for t in range(pos_side.shape[0]):
+        triangle_area_vector(pos_side[t], out[t])
     
-    return A_alpha
+    return out
 
 
 
+# Batched kernels, evaluating a whole mesh in one call. Points are given as an (N,3) array `pos`, and the edges/faces as index arrays 
+# into it. Every kernel accepts preallocated output buffers (returned as well), so that they can be reused between time steps.
 
+@jit(nopython=True, cache=True, parallel=True)
+def edge_lengths(pos, edges, out=None):
+    # lengths of all edges, given as an (M,2) array of indices into pos
+    if out is None:
+        out = np.empty(edges.shape[0])
 
+    for e in prange(edges.shape[0]):
+        a, b = edges[e, 0], edges[e, 1]
+        d0 = pos[b, 0]-pos[a, 0]
+        d1 = pos[b, 1]-pos[a, 1]
+        d2 = pos[b, 2]-pos[a, 2]
+        out[e] = np.sqrt(d0*d0+d1*d1+d2*d2)
 
+    return out
+
+@jit(nopython=True, cache=True, parallel=True)
+def edge_unit_vectors_and_lengths(pos, edges, out_vectors=None, out_lengths=None):
+    # batched unit_vector_and_dist, the unit vectors point from pos[edges[:,0]] to pos[edges[:,1]]
+    if out_vectors is None:
+        out_vectors = np.empty((edges.shape[0], 3))
+    if out_lengths is None:
+        out_lengths = np.empty(edges.shape[0])
+
+    for e in prange(edges.shape[0]):
+        a, b = edges[e, 0], edges[e, 1]
+        d0 = pos[b, 0]-pos[a, 0]
+        d1 = pos[b, 1]-pos[a, 1]
+        d2 = pos[b, 2]-pos[a, 2]
+        dist = np.sqrt(d0*d0+d1*d1+d2*d2)
+        out_vectors[e, 0] = d0/dist
+        out_vectors[e, 1] = d1/dist
+        out_vectors[e, 2] = d2/dist
+        out_lengths[e] = dist
+
+    return out_vectors, out_lengths
+
+@jit(nopython=True, cache=True, parallel=True)
+def triangle_areas_and_vectors_indexed(pos, triangles, out_areas=None, out_vectors=None):
+    # batched triangle_area_and_vector, for triangles given as a (T,3) array of indices into pos
+    if out_areas is None:
+        out_areas = np.empty(triangles.shape[0])
+    if out_vectors is None:
+        out_vectors = np.empty((triangles.shape[0], 3))
+
+    for t in prange(triangles.shape[0]):
+        v0 = 0.0
+        v1 = 0.0
+        v2 = 0.0
+        for i in range(3):
+            a, b = triangles[t, i], triangles[t, i-1] # same orientation as triangle_area_vector
+            v0 += pos[a, 1]*pos[b, 2]-pos[a, 2]*pos[b, 1]
+            v1 += pos[a, 2]*pos[b, 0]-pos[a, 0]*pos[b, 2]
+            v2 += pos[a, 0]*pos[b, 1]-pos[a, 1]*pos[b, 0]
+        out_vectors[t, 0] = v0/2
+        out_vectors[t, 1] = v1/2
+        out_vectors[t, 2] = v2/2
+        out_areas[t] = np.sqrt(v0*v0+v1*v1+v2*v2)/2
+
+    return out_areas, out_vectors
+
+@jit(nopython=True, cache=True, parallel=True)
+def polygon_areas_and_vectors(pos, indptr, indices, out_areas=None, out_vectors=None):
+    # area vectors of polygonal faces with any number of corners, given in CSR form: the corners of face f are pos[indices[indptr[f]:indptr[f+1]]]
+    # these are the sums of the area vectors of the triangles that each edge forms with the origin, i.e., triangle_area_vector for triangles
+    n = indptr.shape[0]-1
+    if out_areas is None:
+        out_areas = np.empty(n)
+    if out_vectors is None:
+        out_vectors = np.empty((n, 3))
+
+    for f in prange(n):
+        start, stop = indptr[f], indptr[f+1]
+        v0 = 0.0
+        v1 = 0.0
+        v2 = 0.0
+        for i in range(start, stop):
+            a = indices[i]
+            b = indices[stop-1] if i == start else indices[i-1]
+            v0 += pos[a, 1]*pos[b, 2]-pos[a, 2]*pos[b, 1]
+            v1 += pos[a, 2]*pos[b, 0]-pos[a, 0]*pos[b, 2]
+            v2 += pos[a, 0]*pos[b, 1]-pos[a, 1]*pos[b, 0]
+        out_vectors[f, 0] = v0/2
+        out_vectors[f, 1] = v1/2
+        out_vectors[f, 2] = v2/2
+        out_areas[f] = np.sqrt(v0*v0+v1*v1+v2*v2)/2
+
+    return out_areas, out_vectors
+
+@jit(nopython=True, cache=True, parallel=True)
+def sort_corners_batched(indptr, indices, centers, pos_nodes, out_indices=None, out_angles=None):
+    # sort_corners for many polygons at once, given in CSR form: the corners of polygon f are indices[indptr[f]:indptr[f+1]], around centers[f]
+    # returns the corners of every polygon sorted in place of indices (same indptr), and their angles relative to the first corner of each polygon
+    if out_indices is None:
+        out_indices = np.empty_like(indices)
+    if out_angles is None:
+        out_angles = np.empty(indices.shape[0])
+
+    for f in prange(indptr.shape[0]-1):
+        start, stop = indptr[f], indptr[f+1]
+        if stop == start:
+            continue
+        u0 = pos_nodes[indices[start], 0]-centers[f, 0]
+        u1 = pos_nodes[indices[start], 1]-centers[f, 1]
+        angles = np.empty(stop-start)
+        for i in range(start, stop):
+            d0 = pos_nodes[indices[i], 0]-centers[f, 0]
+            d1 = pos_nodes[indices[i], 1]-centers[f, 1]
+            angles[i-start] = np.arctan2(u0*d1-u1*d0, u0*d0+u1*d1)
+        angles[0] = 0.0
+        order = np.argsort(angles, kind='mergesort')
+        for i in range(stop-start):
+            out_indices[start+i] = indices[start+order[i]]
+            out_angles[start+i] = angles[order[i]]
+
+    return out_indices, out_angles
+
+@jit(nopython=True, cache=True, parallel=True)
+def polyhedron_volumes(pos, indptr, indices, cell_ptr, cell_faces, cell_signs=None, out=None):
+    # volumes of polyhedral cells with known faces, by the divergence theorem: a third of the sum over the faces of (centroid . area vector),
+    # which is exact for planar faces and skips building any hull. The faces are polygons given in CSR form (see polygon_areas_and_vectors),
+    # and the faces of cell c are cell_faces[cell_ptr[c]:cell_ptr[c+1]]. The faces of each cell must be consistently oriented, after 
+    # multiplying their area vectors by the optional cell_signs (+1/-1, one per entry of cell_faces, for faces shared by neighbouring cells)
+    n_faces = indptr.shape[0]-1
+    moments = np.empty(n_faces)
+    for f in prange(n_faces):
+        start, stop = indptr[f], indptr[f+1]
+        v0 = 0.0
+        v1 = 0.0
+        v2 = 0.0
+        c0 = 0.0
+        c1 = 0.0
+        c2 = 0.0
+        for i in range(start, stop):
+            a = indices[i]
+            b = indices[stop-1] if i == start else indices[i-1]
+            v0 += pos[a, 1]*pos[b, 2]-pos[a, 2]*pos[b, 1]
+            v1 += pos[a, 2]*pos[b, 0]-pos[a, 0]*pos[b, 2]
+            v2 += pos[a, 0]*pos[b, 1]-pos[a, 1]*pos[b, 0]
+            c0 += pos[a, 0]
+            c1 += pos[a, 1]
+            c2 += pos[a, 2]
+        n = max(stop-start, 1)
+        moments[f] = (c0*v0+c1*v1+c2*v2)/(6*n)
+
+    n_cells = cell_ptr.shape[0]-1
+    if out is None:
+        out = np.empty(n_cells)
+    for c in prange(n_cells):
+        volume = 0.0
+        for i in range(cell_ptr[c], cell_ptr[c+1]):
+            if cell_signs is None:
+                volume += moments[cell_faces[i]]
+            else:
+                volume += cell_signs[i]*moments[cell_faces[i]]
+        out[c] = abs(volume)
 
+    return out
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 def RK_handler(f, order=2):
     """
     Implements 2,3,4-order Ralston RK methods
@@ -8,7 +11,7 @@ def RK_handler(f, order=2):
     two_thirds=2/3
     one_quarter=1/4
     three_quarters=3/4
-    one_sixth=1/4
+    one_sixth=1/6
     ############# END CONSTANTS #############
 
     if order==2:
@@ -42,4 +45,171 @@ def RK_handler(f, order=2):
 
             return .17476028*k1  - .55148066*k2 + 1.20553560*k3 + .17118478*k4
 
-    return RK_delta
\ No newline at end of file
+    return RK_delta
+
+
+def embedded_RK_handler(f, method='DP54', jit=False):
+    """
+    Implements the embedded Bogacki-Shampine 3(2) ('BS32') and Dormand-Prince 5(4) ('DP54') RK pairs, for use with `adaptive_RK`.
+
+    Returns a function that can be called as RK_delta(h, f0, x0, *args) to get the RK-increment of the higher order method, along with
+    the RHS at the end of the step f1 = f(x0 + increment, *args) (both pairs are FSAL, so f1 is the f0 of the next step) and the increment
+    of the higher order method minus that of the lower order one, as an estimate of the local error. With `jit`, RK_delta is compiled with 
+    numba's njit, which requires `f` to be njit-compiled as well. The order of the error estimate is attached as `RK_delta.order`.
+    """
+    if method=='BS32':
+
+        ############### CONSTANTS ###############
+        b1, b2, b3 = 2/9, 1/3, 4/9
+        e1, e2, e3, e4 = 2/9-7/24, 1/3-1/4, 4/9-1/3, -1/8
+        ############# END CONSTANTS #############
+
+        def RK_delta(h, f0, x0, *args):
+
+            k1 = h*f0
+            k2 = h*f(x0 + 0.5*k1, *args)
+            k3 = h*f(x0 + 0.75*k2, *args)
+            delta = b1*k1 + b2*k2 + b3*k3
+            f1 = f(x0 + delta, *args)
+
+            return delta, f1, e1*k1 + e2*k2 + e3*k3 + e4*h*f1
+
+        order = 2
+
+    elif method=='DP54':
+
+        ############### CONSTANTS ###############
+        a21 = 1/5
+        a31, a32 = 3/40, 9/40
+        a41, a42, a43 = 44/45, -56/15, 32/9
+        a51, a52, a53, a54 = 19372/6561, -25360/2187, 64448/6561, -212/729
+        a61, a62, a63, a64, a65 = 9017/3168, -355/33, 46732/5247, 49/176, -5103/18656
+        b1, b3, b4, b5, b6 = 35/384, 500/1113, 125/192, -2187/6784, 11/84
+        e1, e3, e4, e5, e6, e7 = 71/57600, -71/16695, 71/1920, -17253/339200, 22/525, -1/40
+        ############# END CONSTANTS #############
+
+        def RK_delta(h, f0, x0, *args):
+
+            k1 = h*f0
+            k2 = h*f(x0 + a21*k1, *args)
+            k3 = h*f(x0 + a31*k1 + a32*k2, *args)
+            k4 = h*f(x0 + a41*k1 + a42*k2 + a43*k3, *args)
+            k5 = h*f(x0 + a51*k1 + a52*k2 + a53*k3 + a54*k4, *args)
+            k6 = h*f(x0 + a61*k1 + a62*k2 + a63*k3 + a64*k4 + a65*k5, *args)
+            delta = b1*k1 + b3*k3 + b4*k4 + b5*k5 + b6*k6
+            f1 = f(x0 + delta, *args)
+
+            return delta, f1, e1*k1 + e3*k3 + e4*k4 + e5*k5 + e6*k6 + e7*h*f1
+
+        order = 4
+
+    else:
+        raise ValueError(f"method must be 'BS32' or 'DP54', not {method!r}")
+
+    if jit:
+        from numba import njit
+        RK_delta = njit(RK_delta)
+
+    RK_delta.order = order
+
+    return RK_delta
+
+
+def adaptive_RK(f, x0, t0, t1, args=(), method='DP54', rtol=1e-6, atol=1e-9, h0=None, h_min=0.0, h_max=np.inf, safety=0.9, 
+                max_factor=5.0, min_factor=0.2, events=None, event_args=(), callback=None, max_steps=None, jit=False):
+    """
+    Integrates dx/dt = f(x, *args) from t0 to t1, with step sizes chosen to keep the local error estimate of an embedded RK pair 
+    (see `embedded_RK_handler`) within `atol + rtol*|x|` (RMS norm over the components of x).
+
+    Args:
+        f: The RHS, with signature f(x, *args) like for `RK_handler`. If `jit` is True, it must be njit-compiled, and so are the steps.
+        x0: The initial state (a float or numpy array).
+        t0, t1: The initial and final times, t1 >= t0.
+
+    Kwargs:
+        args: Extra arguments passed on to f.
+        method: 'DP54' (default) or 'BS32', which is cheaper for loose tolerances.
+        rtol, atol: Relative and absolute error tolerances.
+        h0: Initial step size, estimated from the initial RHS if None.
+        h_min, h_max: Bounds on the step size. Steps that fail the error test at h_min are taken anyway.
+        safety, max_factor, min_factor: Step adaptation h_new = h*clip(safety*err**(-1/(order+1)), min_factor, max_factor).
+        events: A `Events.TimeBasedEventExecutor`. Steps are shortened to land exactly on the time of the next event, and the executor is
+            called with (t, *event_args) after every step. If any event fires, the RHS at the current state is recomputed, since events 
+            may change the `args` (in place). Events do not get the state, which is a new array after every step, so to change it, stop 
+            the integration at the event time instead. Events that are due at t0 (or earlier) fire before the first step.
+        callback: Called as callback(t, x) after every accepted step.
+        max_steps: Raise a RuntimeError after this many (accepted and rejected) steps.
+
+    Returns:
+        x: The state at t1.
+        info: A dict with the number of 'accepted' and 'rejected' steps, of RHS 'evaluations', and the 'h' to use for continuing the integration.
+    """
+    if t1 < t0:
+        raise ValueError(f'adaptive_RK: cannot integrate backwards from t0={t0} to t1={t1}')
+
+    RK_delta = embedded_RK_handler(f, method=method, jit=jit)
+    exponent = -1/(RK_delta.order+1)
+    evaluations_per_step = 3 if method=='BS32' else 6
+
+    t = t0
+    x = x0
+    if events is not None: #events that are already due would otherwise make for steps of zero (or negative) length
+        events(t, *event_args)
+    f0 = f(x, *args)
+    evaluations = 1
+
+    def norm(v):
+        return np.sqrt(np.mean(np.square(v)))
+
+    if h0 is None: #rough guess at a step where the first order change is about 1% of the scale of x
+        scale = atol + rtol*np.abs(x)
+        d0, d1 = norm(x/scale), norm(f0/scale)
+        h = 1e-6 if d0 < 1e-5 or d1 < 1e-5 else 0.01*d0/d1
+    else:
+        h = h0
+    h = min(max(h, h_min), h_max, t1-t0)
+
+    accepted = rejected = 0
+    while t < t1:
+        if max_steps is not None and accepted+rejected >= max_steps:
+            raise RuntimeError(f'adaptive_RK: reached max_steps={max_steps} at t={t}')
+
+        t_stop = t1 if events is None else min(t1, events.next_time())
+        if t_stop <= t: #an event that is due already, e.g. one added by another event
+            if events(t, *event_args):
+                f0 = f(x, *args)
+                evaluations += 1
+            continue
+
+        step = h
+        clipped = t + 1.01*step >= t_stop
+        if clipped: #land on the event/end time, rather than leave a sliver of a step before it
+            step = t_stop - t
+
+        delta, f1, error = RK_delta(step, f0, x, *args)
+        x1 = x + delta
+        err = norm(error/(atol + rtol*np.maximum(np.abs(x), np.abs(x1))))
+
+        if err <= 1 or step <= h_min:
+            t = t_stop if step == t_stop - t else t + step
+            x, f0 = x1, f1
+            accepted += 1
+
+            if callback is not None:
+                callback(t, x)
+
+            if events is not None and events(t, *event_args):
+                f0 = f(x, *args)
+                evaluations += 1
+        else:
+            rejected += 1
+
+        factor = max_factor if err == 0 else min(max_factor, max(min_factor, safety*err**exponent))
+        if err > 1:
+            factor = min(factor, 1.0)
+        h = step*factor if err > 1 or not clipped else max(step*factor, h) #a step shortened to land on an event says nothing about the next one
+        h = min(max(h, h_min), h_max)
+
+    evaluations += evaluations_per_step*(accepted+rejected)
+
+    return x, {'accepted': accepted, 'rejected': rejected, 'evaluations': evaluations, 'h': h}
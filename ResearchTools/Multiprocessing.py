@@ -1,9 +1,19 @@
 '''
 Extends the base python mulitprocessing module to work more consistently across platforms.
 In Windows, this means we use the dill library to pickle the functions.
+
+Also provides persistent worker pools that are reused across calls (e.g., by `Sweep.sweep`), so that workers stay warm with any imported
+modules and JIT-compiled functions, and helpers for passing large arrays between processes through shared memory.
 '''
-import sys
+import atexit, os, signal, sys, threading
 import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+import psutil
+from pathos.pools import ProcessPool, ThreadPool
 
 IS_WINDOWS = sys.platform.startswith('win')
 
@@ -37,3 +47,111 @@ def Process(target, args=tuple(), name=None, kwargs={}, daemon=None):
     else:
         proc = multiprocessing.Process(target=target, name=name, args=args, kwargs=kwargs, daemon=daemon)
     return proc
+
+
+_pools = {}
+
+def default_nodes(threads=False):
+    '''Default number of pool nodes, one less than the number of physical cores (or logical cores for a thread pool), but at least 1.'''
+    count = psutil.cpu_count(logical=threads) or os.cpu_count() or 1
+    return max(count-1, 1)
+
+def persistent_pool(nodes=None, threads=False):
+    '''Returns the module-level worker pool, creating it if needed. The same pool is returned on every call, until `shutdown_pools` is called.
+
+    Kwargs:
+        nodes : number of workers in the pool. If `None` (the default), any existing pool is returned as is, otherwise a new pool with
+            `default_nodes(threads)` workers is created. If an existing pool has a different number of workers, it is replaced.
+        threads : return a `pathos` ThreadPool (for IO-bound work) instead of a ProcessPool. Default is `False`.
+    Returns:
+        a `pathos` pool
+    '''
+    key = (threads, os.getpid()) # pools are not inherited by forked processes
+    pool = _pools.get(key)
+
+    if pool is not None:
+        if nodes is None or pool.nodes == nodes:
+            return pool
+        _shutdown(_pools.pop(key))
+
+    if nodes is None:
+        nodes = default_nodes(threads)
+
+    pool = (ThreadPool if threads else ProcessPool)(nodes=nodes)
+    _pools[key] = pool
+
+    if not threads and threading.current_thread() is threading.main_thread():
+        #setup a graceful exit
+        signal.signal(signal.SIGTERM, lambda a,b: shutdown_pools(terminate=True))
+
+    return pool
+
+def shutdown_pools(terminate=False):
+    '''Shuts down all pools created by `persistent_pool`, waiting for any running tasks to finish unless `terminate` is `True`.'''
+    for key in list(_pools.keys()):
+        _shutdown(_pools.pop(key), terminate=terminate)
+
+def _shutdown(pool, terminate=False):
+    if terminate:
+        pool.terminate()
+    else:
+        pool.close()
+        pool.join()
+    pool.clear()
+
+@contextmanager
+def managed_pool(nodes=None, threads=False):
+    '''Context manager that provides a `persistent_pool` for the duration of the block, and shuts down all persistent pools on exit.'''
+    try:
+        yield persistent_pool(nodes=nodes, threads=threads)
+    finally:
+        shutdown_pools()
+
+atexit.register(shutdown_pools, terminate=True)
+
+
+SharedArray = namedtuple('SharedArray', ['name', 'shape', 'dtype'])
+SharedArray.__doc__ = '''Handle to an array that was placed in a shared memory block by `share_array`, cheap to send to another process.'''
+
+def share_array(a):
+    '''Copies the array `a` into a new shared memory block and returns a `SharedArray` handle for it.
+
+    Ownership of the block passes to whichever process calls `receive_array` on the handle, which also frees the block.
+    '''
+    a = np.asarray(a)
+    try:
+        shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1), track=False) # python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+        resource_tracker.unregister(shm._name, 'shared_memory') # otherwise this process' tracker frees the block when it exits
+
+    np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+    handle = SharedArray(shm.name, a.shape, a.dtype.str)
+    shm.close()
+
+    return handle
+
+def receive_array(handle, out=None):
+    '''Returns a copy of the array behind a `SharedArray` handle (written into `out`, if given), and frees the shared memory block.'''
+    shm = shared_memory.SharedMemory(name=handle.name)
+    try:
+        shared = np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=shm.buf)
+        if out is None:
+            out = shared.copy()
+        else:
+            out[...] = shared
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return out
+
+def release_array(handle):
+    '''Frees the shared memory block behind a `SharedArray` handle without reading it, e.g. for results that will never be received.'''
+    try:
+        shm = shared_memory.SharedMemory(name=handle.name)
+    except FileNotFoundError:
+        return # already freed
+    shm.close()
+    shm.unlink()
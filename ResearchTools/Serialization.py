@@ -0,0 +1,208 @@
+'''
+Serializers for persisting results, chosen by file extension (or by the type of the result, see `extension_for`).
+
+    - '.pickle' / '.pkl': plain `pickle`, works for any picklable object.
+    - '.pkl5': pickle protocol 5 with the data of any (contiguous) NumPy arrays stored out-of-band and aligned, so they can be memory-mapped on load.
+    - '.npy': a single NumPy array, which can be memory-mapped on load.
+    - '.npz': a dict of NumPy arrays.
+
+Memory-mapped results are read-only, and only the pages that are actually accessed are read from disk. Files smaller than `MMAP_MIN_BYTES`
+are always read into memory, as every mapping takes up one of the limited number of memory maps of a process (`vm.max_map_count`).
+
+Any of these can be compressed by appending a compression suffix to the extension, e.g. '.npy.xz' (see `COMPRESSORS`). 
+Compressed results are never memory-mapped. The 'blosc' compressor is only available if the `blosc` package is installed.
+'''
+
+import bz2, io, lzma, mmap, os, pickle, struct, time, zlib
+
+import numpy as np
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+from .Filesystem import write_atomic
+
+
+def _pickle_dump(obj, file):
+    pickle.dump(obj, file)
+
+def _pickle_load(file, mmap_mode=None):
+    return pickle.load(file)
+
+
+CORRUPT_ERRORS = (EOFError, pickle.UnpicklingError, ValueError, struct.error, zlib.error, lzma.LZMAError)
+'''
+Exceptions raised by `load` and `loads` for data that is truncated or otherwise corrupt, as opposed to e.g. unreadable files or missing classes. 
+Intact data can raise a ValueError too (e.g., a pickle protocol that is too new for this interpreter), so results that raise these are suspect 
+rather than certainly corrupt.
+'''
+
+MMAP_MIN_BYTES = 1 << 20
+'''Size in bytes below which files are read into memory rather than memory-mapped.'''
+
+
+_PKL5_MAGIC = b'RTPKL5\0\0'
+_PKL5_ALIGN = 64
+
+def _pkl5_dump(obj, file):
+    buffers = []
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    raws = [b.raw() for b in buffers]
+
+    header = _PKL5_MAGIC + struct.pack(f'<QQ{len(raws)}Q', len(raws), len(data), *[r.nbytes for r in raws])
+    file.write(header)
+    file.write(data)
+    offset = len(header) + len(data)
+    for raw in raws:
+        pad = -offset % _PKL5_ALIGN
+        file.write(b'\0'*pad)
+        file.write(raw)
+        offset += pad + raw.nbytes
+
+def _pkl5_load(file, mmap_mode=None):
+    if mmap_mode is not None and hasattr(file, 'fileno'):
+        view = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+    else:
+        view = memoryview(bytearray(file.read())) # writable, so that the arrays are too (as with plain pickle)
+
+    if bytes(view[:8]) != _PKL5_MAGIC:
+        raise pickle.UnpicklingError('not a .pkl5 file')
+
+    n, length = struct.unpack_from('<QQ', view, 8)
+    sizes = struct.unpack_from(f'<{n}Q', view, 24)
+    offset = 24 + 8*n
+    data = view[offset:offset+length]
+    offset += length
+
+    buffers = []
+    for size in sizes:
+        offset += -offset % _PKL5_ALIGN
+        buffers.append(view[offset:offset+size])
+        offset += size
+
+    return pickle.loads(data, buffers=buffers)
+
+
+def _npy_dump(obj, file):
+    np.save(file, obj, allow_pickle=False)
+
+def _npy_load(file, mmap_mode=None):
+    if mmap_mode is not None and hasattr(file, 'fileno'):
+        out = np.load(file.name, mmap_mode=mmap_mode, allow_pickle=False)
+    else:
+        out = np.load(file, allow_pickle=False)
+    return out[()] if out.ndim == 0 else out # scalars are saved as 0-d arrays
+
+
+def _npz_dump(obj, file):
+    np.savez(file, **obj)
+
+def _npz_load(file, mmap_mode=None):
+    with np.load(file, allow_pickle=False) as npz:
+        return dict(npz)
+
+
+SERIALIZERS = {'.pickle': (_pickle_dump, _pickle_load),
+               '.pkl': (_pickle_dump, _pickle_load),
+               '.pkl5': (_pkl5_dump, _pkl5_load),
+               '.npy': (_npy_dump, _npy_load),
+               '.npz': (_npz_dump, _npz_load)}
+'''Maps file extensions to `(dump(obj, file), load(file, mmap_mode=None))` pairs, other extensions fall back to pickle.'''
+
+
+COMPRESSORS = {'.zlib': (lambda data, level: zlib.compress(data, -1 if level is None else level), zlib.decompress),
+               '.xz': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+               '.bz2': (lambda data, level: bz2.compress(data, 9 if level is None else level), bz2.decompress)}
+'''Maps compression suffixes to `(compress(data, level), decompress(data))` pairs, where `level=None` selects the default level.'''
+
+if blosc is not None:
+    COMPRESSORS['.blosc'] = (lambda data, level: blosc.compress(data, clevel=5 if level is None else level), blosc.decompress)
+
+COMPRESSION = {'zlib': '.zlib', 'lzma': '.xz', 'bz2': '.bz2', 'blosc': '.blosc'}
+'''Maps compression method names to their suffixes.'''
+
+
+def split_extension(path):
+    '''The serializer extension and compression suffix (or None) of an extension or path, e.g. 'a/b.npy.xz' -> ('.npy', '.xz').'''
+    name = '_' + os.path.basename(path) # so that a bare extension is not taken for a hidden file
+    for suffix in COMPRESSORS:
+        if name.endswith(suffix):
+            return os.path.splitext(name[:-len(suffix)])[1], suffix
+    return os.path.splitext(name)[1], None
+
+def extension_for(obj):
+    '''The extension of the most efficient serializer for `obj`: '.npy' for numeric arrays, '.npz' for dicts of arrays, '.pickle' otherwise.'''
+    if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+        return '.npy'
+    if isinstance(obj, dict) and obj and all(isinstance(k, str) and isinstance(v, np.ndarray) and not v.dtype.hasobject for k, v in obj.items()):
+        return '.npz'
+    return '.pickle'
+
+def _serializer(extension):
+    return SERIALIZERS.get(extension, SERIALIZERS['.pickle'])
+
+
+def dumps(obj, extension='.pickle', level=None):
+    '''Serialize `obj` to bytes, using the serializer (and compression, at the given `level`) for `extension`.'''
+    extension, compression = split_extension(extension)
+
+    buffer = io.BytesIO()
+    _serializer(extension)[0](obj, buffer)
+    data = buffer.getvalue()
+
+    return data if compression is None else COMPRESSORS[compression][0](data, level)
+
+def loads(data, extension='.pickle', sizes=None):
+    '''Deserialize bytes produced by `dumps`. If a `sizes` dict is given, the 'stored' and 'raw' (uncompressed) sizes in bytes are written to it.'''
+    extension, compression = split_extension(extension)
+
+    stored = len(data)
+    if compression is not None:
+        data = COMPRESSORS[compression][1](data)
+
+    if sizes is not None:
+        sizes['stored'], sizes['raw'] = stored, len(data)
+
+    return _serializer(extension)[1](io.BytesIO(data))
+
+def save(obj, path, level=None, timings=None):
+    '''
+    Atomically save `obj` to `path`, using the serializer (and compression, at the given `level`) for the extension of `path`.
+
+    If a `timings` dict is given, the seconds spent serializing and writing are added to its 'serialize' and 'write' entries, and the 
+    number of bytes written to 'bytes'. To tell the two apart, the result is then serialized in memory even if it could be streamed to the file.
+    '''
+    extension, compression = split_extension(path)
+
+    if timings is not None:
+        start = time.perf_counter()
+        data = dumps(obj, path, level=level)
+        serialized = time.perf_counter()
+        write_atomic(path, data)
+        timings['serialize'] = timings.get('serialize', 0) + serialized - start
+        timings['write'] = timings.get('write', 0) + time.perf_counter() - serialized
+        timings['bytes'] = timings.get('bytes', 0) + len(data)
+    elif compression is None:
+        write_atomic(path, lambda file: _serializer(extension)[0](obj, file))
+    else:
+        write_atomic(path, dumps(obj, extension + compression, level=level))
+
+def load(path, mmap=True, sizes=None):
+    '''
+    Load an object saved by `save`. If `mmap` is True, array data is memory-mapped (read-only) wherever the format allows it,
+    unless the file is smaller than `MMAP_MIN_BYTES`. If a `sizes` dict is given, the 'stored' and 'raw' (uncompressed) sizes in bytes are written to it.
+    '''
+    extension, compression = split_extension(path)
+
+    with open(path, 'rb') as file:
+        if compression is None:
+            size = os.fstat(file.fileno()).st_size
+            if sizes is not None:
+                sizes['stored'] = sizes['raw'] = size
+            return _serializer(extension)[1](file, mmap_mode='r' if mmap and size >= MMAP_MIN_BYTES else None)
+
+        data = file.read()
+
+    return loads(data, extension + compression, sizes=sizes)
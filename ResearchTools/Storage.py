@@ -0,0 +1,401 @@
+'''
+Result stores for persisting the outputs of function calls, primarily intended for use by the Sweep module.
+
+A store is a closure that maps string keys (typically produced by `Caching.signature_string`) onto serialized results.
+Calling the store with a key loads the corresponding result, while the following methods are attached to it:
+    - `exists(keys)`: bool np.array flagging which of the `keys` have a stored result.
+    - `load(key, sizes=None)` / `load_many(keys)`: load one or many results, `sizes` is an optional dict that receives the 'stored' and 
+        'raw' (uncompressed) sizes in bytes of the result.
+    - `save(key, obj, timings=None)` / `save_many(items, timings=None)`: save one result, or an Iterable of (key, obj) pairs. `timings` is 
+        an optional dict that accumulates the seconds spent serializing and writing ('serialize' and 'write') and the bytes written ('bytes').
+    - `size(key)`: size of the stored result in bytes.
+    - `path(key)`: human-readable location of the stored result.
+    - `delete(key)`: remove a result, if it exists.
+    - `quarantine(key)`: move a suspect (e.g., seemingly corrupt) result out of the way under the key `key + '.corrupt'`, 
+        so that it no longer counts as stored but can still be inspected, replacing any result quarantined earlier.
+    - `claim(key)` / `claim_many(keys)` / `release(keys)` / `claimed(keys)`: claims announce that a process is computing a result, so that 
+        concurrent sweeps over the same grid can split the work. `claim` returns False if another live process holds the claim (`claim_many` 
+        a bool np.array), claims expire after `lease` seconds, or as soon as their owner is found to be dead. `claimed` flags the keys with 
+        a claim held by another process.
+    - `save_runtimes(items)` / `runtimes(keys)`: record the wall time in seconds of computing results, from an Iterable of (key, seconds) pairs, 
+        and look up the latest recorded times of the `keys` as a float np.array (nan where unknown).
+
+Stores are created by factories with signature `factory(basedir, extension)`, so they can be passed to `Sweep.sweep` via its `store` keyword.
+The `extension` selects the serializer used for the results (see the `Serialization` module), with '.auto' choosing it by the type of each result.
+A compression suffix may be appended to the extension (e.g., '.pickle.xz'), in which case results are compressed/decompressed by whichever
+process saves/loads them, at the `compression_level` given to the factory.
+'''
+
+import os, socket, time
+
+import numpy as np
+
+from . import Serialization
+from .Filesystem import write_atomic, sqlite_connect
+
+
+def _is_auto(extension):
+    return extension == 'auto' or Serialization.split_extension(extension)[0] == '.auto'
+
+
+_OWNER = socket.gethostname()
+
+def _owner():
+    '''claim owner of the current process, the pid changes in the workers of a pool'''
+    return f'{_OWNER}:{os.getpid()}'
+
+def _stale(owner, since, lease):
+    '''whether a claim taken by `owner` at time `since` has expired, or belongs to a process on this host that no longer exists'''
+    if time.time() - since > lease:
+        return True
+
+    host, _, pid = owner.rpartition(':')
+    if host == _OWNER and pid.isdigit():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+
+    return False
+
+
+def _read_runtimes(path):
+    '''latest recorded runtime of every key in a runtime log (see `FileStore`), and the number of lines in the log'''
+    runtimes, lines = {}, 0
+    try:
+        with open(path) as file:
+            for line in file:
+                lines += 1
+                key, _, seconds = line.rstrip('\n').rpartition('\t')
+                try:
+                    runtimes[key] = float(seconds)
+                except ValueError:
+                    pass # partially written line
+    except FileNotFoundError:
+        pass
+
+    return runtimes, lines
+
+def _format_runtimes(items):
+    return ''.join(f'{key}\t{seconds:.6g}\n' for key, seconds in items)
+
+
+def FileStore(basedir, extension='.pickle', mmap=False, compression_level=None, lease=3600):
+    '''
+    Store where every result lives in its own file, `os.path.join(basedir, key + extension)`. This is the default layout used by `Sweep.sweep`.
+
+    With the '.auto' extension, each result is saved with the extension returned by `Serialization.extension_for`. If `mmap` is True,
+    the array data of large results is memory-mapped on load wherever the serializer allows it, rather than read into memory 
+    (see `Serialization.load`), e.g. `functools.partial(FileStore, mmap=True)` for the `store` of a sweep. Default is False.
+
+    Claims are files next to the results, `key + '.claim'`, created exclusively and holding the name of their owner.
+    Runtimes are appended to a tab separated log, `.runtimes.tsv` in `basedir`, which is compacted to one line per key once it has grown
+    to more than twice that when read.
+    '''
+    auto = _is_auto(extension)
+    compression = Serialization.split_extension(extension)[1] or ''
+    extensions = {} # extension of each key found by `exists`, only needed for '.auto'
+
+    def ext(key):
+        if not auto:
+            return extension
+        if key not in extensions:
+            for e in Serialization.SERIALIZERS:
+                if os.path.exists(os.path.join(basedir, key + e + compression)):
+                    extensions[key] = e + compression
+                    break
+            else:
+                return extension
+        return extensions[key]
+
+    def path(key):
+        return os.path.join(basedir, key + ext(key))
+
+    def exists(keys):
+        if len(keys) <= 16: #a few stat calls are cheaper than listing a large directory
+            return np.array([os.path.exists(path(key)) for key in keys], dtype=bool)
+
+        #a single pass over the directory listing is much cheaper than one `os.path.exists` per key on large (or networked) filesystems
+        names = set()
+        if os.path.isdir(basedir):
+            with os.scandir(basedir) as entries:
+                names.update(entry.name for entry in entries)
+
+        if not auto:
+            return np.array([key + extension in names for key in keys], dtype=bool)
+
+        for name in names:
+            if name.endswith(compression):
+                stem, e = os.path.splitext(name[:len(name)-len(compression)])
+                if e in Serialization.SERIALIZERS:
+                    extensions[stem] = e + compression
+
+        return np.array([key in extensions for key in keys], dtype=bool)
+
+    def load(key, sizes=None):
+        return Serialization.load(path(key), mmap=mmap, sizes=sizes)
+
+    def load_many(keys):
+        return [load(key) for key in keys]
+
+    def save(key, obj, timings=None):
+        e = Serialization.extension_for(obj) + compression if auto else extension
+        Serialization.save(obj, os.path.join(basedir, key + e), level=compression_level, timings=timings)
+        if auto:
+            extensions[key] = e
+
+    def save_many(items, timings=None):
+        for key, obj in items:
+            save(key, obj, timings=timings)
+
+    def size(key):
+        return os.path.getsize(path(key))
+
+    def delete(key):
+        try:
+            os.remove(path(key))
+        except FileNotFoundError:
+            pass
+        extensions.pop(key, None)
+
+    def quarantine(key):
+        try:
+            os.replace(path(key), path(key) + '.corrupt')
+        except FileNotFoundError:
+            pass
+        extensions.pop(key, None)
+
+    def claim_path(key):
+        return os.path.join(basedir, key + '.claim')
+
+    def holder(key):
+        '''owner of a live claim on `key` (possibly this process), or None'''
+        try:
+            with open(claim_path(key)) as file:
+                owner = file.read()
+            since = os.path.getmtime(claim_path(key))
+        except FileNotFoundError:
+            return None
+        return None if _stale(owner, since, lease) else owner
+
+    def claim(key):
+        os.makedirs(basedir, exist_ok=True)
+        for attempt in range(2):
+            try:
+                fd = os.open(claim_path(key), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                owner = holder(key)
+                if owner is not None:
+                    return owner == _owner()
+                try:
+                    os.remove(claim_path(key)) #stale, take it over
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, 'w') as file:
+                file.write(_owner())
+            return True
+        return False
+
+    def claim_many(keys):
+        return np.array([claim(key) for key in keys], dtype=bool)
+
+    def release(keys):
+        for key in keys:
+            try:
+                os.remove(claim_path(key))
+            except FileNotFoundError:
+                pass
+
+    def claimed(keys):
+        me = _owner()
+        return np.array([holder(key) not in (None, me) for key in keys], dtype=bool)
+
+    runtimes_path = os.path.join(basedir, '.runtimes.tsv')
+
+    def save_runtimes(items):
+        items = list(items)
+        if not items:
+            return
+        os.makedirs(basedir, exist_ok=True)
+        with open(runtimes_path, 'a') as file: #a single write, so that concurrent appends do not interleave
+            file.write(_format_runtimes(items))
+
+    def runtimes(keys):
+        known, lines = _read_runtimes(runtimes_path)
+        if lines > 2*len(known) + 64:
+            #times appended by other processes while compacting are lost, which only costs their estimates
+            write_atomic(runtimes_path, _format_runtimes(known.items()).encode())
+        return np.array([known.get(key, np.nan) for key in keys], dtype=float)
+
+    out = load
+    out.load = load
+    out.load_many = load_many
+    out.save = save
+    out.save_many = save_many
+    out.exists = exists
+    out.size = size
+    out.delete = delete
+    out.quarantine = quarantine
+    out.claim = claim
+    out.claim_many = claim_many
+    out.release = release
+    out.claimed = claimed
+    out.save_runtimes = save_runtimes
+    out.runtimes = runtimes
+    out.path = path
+    out.basedir = basedir
+    out.extension = extension
+
+    return out
+
+
+_SCHEMA = ('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB NOT NULL)',
+           'CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, owner TEXT NOT NULL, since REAL NOT NULL)',
+           'CREATE TABLE IF NOT EXISTS runtimes (key TEXT PRIMARY KEY, seconds REAL NOT NULL)')
+
+def _connect(db):
+    return sqlite_connect(db, _SCHEMA)
+
+
+def SQLiteStore(basedir, extension='.pickle', compression_level=None, lease=3600):
+    '''
+    Store where all results are kept as rows of a single indexed SQLite file, `basedir + '.sqlite'`, keyed by `key + extension`.
+
+    This avoids creating one file per result, which can overwhelm the metadata servers of parallel filesystems for large sweeps.
+    Results are serialized in memory and cannot be memory-mapped, '.auto' uses '.pkl5' for every result. Claims and runtimes are rows of separate tables.
+    The file can be shared by processes on different hosts, as long as the filesystem supports file locking (e.g., for a work queue).
+    '''
+    db = basedir.rstrip(os.sep) + '.sqlite'
+    serializer = extension
+    if _is_auto(extension):
+        serializer = '.pkl5' + (Serialization.split_extension(extension)[1] or '')
+
+    def path(key):
+        return db + '::' + key + extension
+
+    def exists(keys):
+        keys = [key + extension for key in keys]
+        found = set()
+        conn = _connect(db)
+        for i in range(0, len(keys), 500): #stay under sqlite's limit on the number of bound variables
+            batch = keys[i:i+500]
+            rows = conn.execute(f'SELECT key FROM results WHERE key IN ({",".join("?"*len(batch))})', batch)
+            found.update(r[0] for r in rows)
+
+        return np.array([key in found for key in keys], dtype=bool)
+
+    def load(key, sizes=None):
+        row = _connect(db).execute('SELECT value FROM results WHERE key=?', (key + extension,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return Serialization.loads(row[0], serializer, sizes=sizes)
+
+    def load_many(keys):
+        keys = [key + extension for key in keys]
+        blobs = {}
+        conn = _connect(db)
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i+500]
+            rows = conn.execute(f'SELECT key, value FROM results WHERE key IN ({",".join("?"*len(batch))})', batch)
+            blobs.update(rows)
+
+        return [Serialization.loads(blobs[key], serializer) for key in keys]
+
+    def save(key, obj, timings=None):
+        save_many(((key, obj),), timings=timings)
+
+    def save_many(items, timings=None):
+        start = time.perf_counter()
+        rows = [(key + extension, Serialization.dumps(obj, serializer, level=compression_level)) for key, obj in items]
+        serialized = time.perf_counter()
+        conn = _connect(db)
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)', rows)
+
+        if timings is not None:
+            timings['serialize'] = timings.get('serialize', 0) + serialized - start
+            timings['write'] = timings.get('write', 0) + time.perf_counter() - serialized
+            timings['bytes'] = timings.get('bytes', 0) + sum(len(row[1]) for row in rows)
+
+    def size(key):
+        row = _connect(db).execute('SELECT length(value) FROM results WHERE key=?', (key + extension,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def delete(key):
+        _connect(db).execute('DELETE FROM results WHERE key=?', (key + extension,))
+
+    def quarantine(key):
+        _connect(db).execute('UPDATE OR REPLACE results SET key=? WHERE key=?', (key + extension + '.corrupt', key + extension))
+
+    def claim(key):
+        return claim_many([key])[0]
+
+    def claim_many(keys):
+        held = np.zeros(len(keys), dtype=bool)
+        conn = _connect(db)
+        with conn: #a single transaction for all of them
+            conn.execute('BEGIN IMMEDIATE')
+            for i, key in enumerate(keys):
+                row = conn.execute('SELECT owner, since FROM claims WHERE key=?', (key + extension,)).fetchone()
+                held[i] = row is None or row[0] == _owner() or _stale(*row, lease)
+            conn.executemany('INSERT OR REPLACE INTO claims (key, owner, since) VALUES (?, ?, ?)', 
+                             [(key + extension, _owner(), time.time()) for key, h in zip(keys, held) if h])
+        return held
+
+    def release(keys):
+        conn = _connect(db)
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('DELETE FROM claims WHERE key=? AND owner=?', [(key + extension, _owner()) for key in keys])
+
+    def claimed(keys):
+        conn = _connect(db)
+        rows = {}
+        for key in keys:
+            row = conn.execute('SELECT owner, since FROM claims WHERE key=?', (key + extension,)).fetchone()
+            if row is not None:
+                rows[key] = row
+        return np.array([key in rows and rows[key][0] != _owner() and not _stale(*rows[key], lease) for key in keys], dtype=bool)
+
+    def save_runtimes(items):
+        rows = [(key + extension, seconds) for key, seconds in items]
+        if not rows:
+            return
+        conn = _connect(db)
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT OR REPLACE INTO runtimes (key, seconds) VALUES (?, ?)', rows)
+
+    def runtimes(keys):
+        keys = [key + extension for key in keys]
+        known = {}
+        conn = _connect(db)
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i+500]
+            known.update(conn.execute(f'SELECT key, seconds FROM runtimes WHERE key IN ({",".join("?"*len(batch))})', batch))
+        return np.array([known.get(key, np.nan) for key in keys], dtype=float)
+
+    out = load
+    out.load = load
+    out.load_many = load_many
+    out.save = save
+    out.save_many = save_many
+    out.exists = exists
+    out.size = size
+    out.delete = delete
+    out.quarantine = quarantine
+    out.claim = claim
+    out.claim_many = claim_many
+    out.release = release
+    out.claimed = claimed
+    out.save_runtimes = save_runtimes
+    out.runtimes = runtimes
+    out.path = path
+    out.basedir = basedir
+    out.extension = extension
+
+    return out
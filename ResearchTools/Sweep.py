@@ -4,24 +4,27 @@ Module for sweeping over the 'parameter space' of a function, where parameters m
 Local caching functionality is also provided, very useful for functions that are very slow to exectue.
 '''
 
-import os, pickle, multiprocessing, psutil
+import asyncio, os, threading, time
+from collections import OrderedDict
 from collections.abc import Iterable
-from itertools import product
-import signal
-
-from pathos.pools import ProcessPool as Pool
-from pathos.pools import ThreadPool as ThreadPool
+from concurrent.futures import wait as futures_wait
+from itertools import islice, product
 
 import numpy as np
 
 from .Iterable import args_nd_shape, first_item
 from .Dict import hash384, dict_product, dict_product_nd_shape
-from .Caching import cache_file, function_savedir,  signature_lists, signature_string
+from .Caching import function_savedir, function_hash, signature_formatter
 from .Filesystem import ensure_directory_exists
+from .Storage import FileStore
+from .WorkQueue import SQLiteQueue
+from . import Serialization
+from .Multiprocessing import persistent_pool, share_array, receive_array, release_array, SharedArray
 
 def sweep(*args, kw={}, expand_kw=True, savepath_prefix='.', extension='.pickle', overwrite=False, 
             pool=None, pre_process=None, pre_process_kw={}, pass_kw=False, dry_run=False, print_code=False,
-            inpaint=None, cache=False, refresh=False, verbose=True, dtype=None):
+            inpaint=None, cache=False, refresh=False, verbose=True, dtype=None, store=FileStore, chunksize=None, reducer=None,
+            point_shape=None, out=None, transport='pickle', content_hash=False, deps=(), compression=None, lazy=False, queue=None, claims=False, instrument=None):
     '''
     Perform a sweep of a function over all parameter and keyword combinations, or retrieve corresponding results from local storage.
 
@@ -39,12 +42,18 @@ def sweep(*args, kw={}, expand_kw=True, savepath_prefix='.', extension='.pickle'
         savepath_prefix (str): The base path where results are to be saved/loaded. Default is the present working directory '.'.
             The actual cache subdirectory for any function "f" is specified by `Caching.function_savedir(f)`.
 
-        extension (str): The file extension for the serialized results. Default is '.pickle'.
+        extension (str): The file extension for the serialized results, which also selects the serializer (see the `Serialization` module), 
+            e.g. '.npy' for array results (which can be memory-mapped when loaded, see `Storage.FileStore`). 'auto' picks the serializer by the type of each result. 
+            Default is '.pickle'.
 
         overwrite (bool): Controls whether existing results are to be overwritten. Default is False.
 
-        pool (Mappable worker pool): The worker pool that carries out the function evaluations. If None (default), 
-            then a mulitprocessing pool with n-1 nodes is created, where n is the number of physical cores on the machine.
+        pool (worker pool): The worker pool that carries out the function evaluations. If None (default), 
+            then `Multiprocessing.persistent_pool()` is used, which by default has n-1 nodes where n is the number of physical cores 
+            on the machine. This pool is reused by later calls, see `Multiprocessing.managed_pool` for scoping its lifetime.
+            Tasks are submitted one at a time, so the pool must have an `apipe` (`pathos` pools), `apply_async` (`multiprocessing.Pool`) 
+            or `submit` (`concurrent.futures` executors) method. Pools of processes must be able to send closures to their workers, 
+            which the `dill` based `pathos` pools can, but the others cannot.
 
         pre_process (function): A function for pre-processing results after function execution or loading from storage.
             Default is None. Results are also cached in subdirectories of ".cache" specified by `Caching.function_savedir(pre_process)`.
@@ -62,42 +71,363 @@ def sweep(*args, kw={}, expand_kw=True, savepath_prefix='.', extension='.pickle'
         inpaint (Any): If not None, do not evaluate any function(s), but replace any results that are missing from the cache
             with `inpaint`. Default is None.
 
-        cache (bool): If pre_process is not None, the processed results are stored in a local cache for rapid later retrieval.
-             Default is False.
+        cache (bool): If pre_process is not None, the processed result of every grid point is stored in a local cache for rapid later 
+            retrieval, in a `store` under ".cache/" + `Caching.function_savedir(pre_process)`. Each entry is keyed on the stored (raw) result 
+            and the keywords passed to `pre_process`, so extending a sweep only processes the new grid points and overlapping sweeps share 
+            their cached work. With `content_hash`, the implementation of `pre_process` is part of the key as well. Default is False.
 
         refresh (bool): If pre_process is not None and cache is True, ignore the current cache and overwrite it after processing. 
             Default is False.
         
-        verbose (bool): Controls whether a message is printed when files are loaded. Default is True.
+        verbose (bool): Controls whether a message is printed when files are loaded or functions evaluated, along with the estimated time 
+            to completion as chunks finish. Default is True.
 
         dtype (type): a dtype that results should be cast to using `np.array()`.
 
+        store (function): Factory with signature `store(basedir, extension)` for the result store that results are saved to/loaded from,
+            see the `Storage` module. Default is `Storage.FileStore`, which saves each result to its own file in `basedir`. 
+            `Storage.SQLiteStore` keeps all the results of a function in a single indexed file instead.
+
+        chunksize (int): Number of contiguous grid points evaluated by each task sent to the `pool`, the results of a chunk are sent back
+            (and saved) together. Larger chunks amortize the communication overhead for fast functions. If None (default), the grid points 
+            are split into roughly four chunks per pool node.
+            The wall time of every evaluation is recorded in the `store` (if it supports that, see the `Storage` module). Once runtimes are 
+            known for a function, grid points are evaluated longest-first, and (if `chunksize` is None) the chunks are sized to take about equally long.
+
+        reducer (tuple): A pair `(init, combine)` for folding the results into a single accumulator as they stream in from the workers 
+            (see `sweep_iter`), instead of holding all of them in memory. Starting from `acc = init`, `acc = combine(acc, grid_index, result)` 
+            is called once for every grid point, and the final `acc` is returned instead of an array. Use `pre_process` to reduce each result 
+            to a fixed-size summary in the workers beforehand. Cannot be combined with `print_code`, `lazy`, `dtype`, `point_shape` or `out`.
+            Default is None.
+
+        point_shape (tuple or str): Shape of the (numeric) result of each grid point, e.g. `()` for scalars. If given, the results are written 
+            into a preallocated contiguous array with this trailing shape and the given `dtype`, rather than collected in an object array. 
+            Use 'infer' (or leave `dtype` as None) to take the missing parts of this spec from the first result. Grid points without a 
+            result are set to `inpaint`, or left at zero if `inpaint` is None. Default is None.
+
+        out (np.ndarray or str): Preallocated output for typed results, implies a typed output (see `point_shape`). Either an array of shape
+            [*grid_shape, *point_shape], or the filename of a `.npy` memory-map to be created. If the output spec is fully known up front, 
+            the workers write their results straight into the memory-map instead of sending them back. Default is None.
+
+        transport (str): How results are sent back from the worker processes. 'pickle' (default) sends them through the pool, while 'shm' 
+            places large array results in `multiprocessing.shared_memory` blocks and only sends a handle, avoiding the serialization copies.
+
+        content_hash (bool): Key the results on the implementation of the function as well, by storing them in a subdirectory named after
+            `Caching.function_hash(func, deps)`. Results are then recomputed whenever the function's code (or that of its `deps`) changes, 
+            while results of unchanged functions remain cached. Default is False.
+
+        deps (Iterable): Functions or modules that the function depends on, to be included in its `content_hash`. Default is ().
+
+        compression (str or tuple): Compress stored results with 'zlib', 'lzma', 'bz2' or 'blosc' (if installed), optionally given as a 
+            `(method, level)` pair. Compression happens in the workers that compute the results, and decompression in the (thread or 
+            process) pool that loads them. This appends the suffix `Serialization.COMPRESSION[method]` to the `extension`. Default is None.
+
+        lazy (bool or int): Do not evaluate or load anything up front, instead return a `LazySweepArray` that loads (and pre-processes) 
+            only the grid points that are indexed, and keeps up to `lazy` of them (128 if True) in a cache. Cannot be combined with `instrument`. 
+            Default is False.
+
+        queue (str or queue): Work queue shared with other processes running the same sweep, e.g. the same script launched on several hosts. 
+            Either the path of a SQLite file on a filesystem shared by all of them, or a queue made by `WorkQueue.SQLiteQueue`. Grid points that
+            are not yet stored are then claimed from the queue one chunk at a time, so each is evaluated by a single process, and claims of 
+            crashed processes expire after the queue's lease. Results land in the usual `store`, and every process returns the full results
+            once the queue is drained. With `overwrite`, the first process queues every grid point again, while processes that join before 
+            the queue is drained only take on what is left. Default is None.
+
+        claims (bool): Without a `queue`, claim every grid point in the `store` right before evaluating it (see the `Storage` module), so that 
+            concurrent sweeps over the same grid split the work rather than duplicating it, and points claimed by others are loaded once their 
+            result is stored. This costs a claim and a check of the store per grid point. Default is False.
+
+        instrument (bool or callable): Record where the time goes, as events for the grid points of every task: 'queue_wait' (from submission 
+            to the start of a chunk), 'compute', 'serialize', 'write', 'load', 'cache_load' (of pre-processed results), 'pre_process' and 'missing'.
+            Each event is a dict with the keys 'event', 'points' (indices into the raveled grid), 'seconds', 'bytes', 'pid' and 'time'. 
+            If a callable, it is called with every event as the results arrive. If given at all, `sweep` returns a `(results, summary)` pair, 
+            where `summary` is a dict of aggregate counters: 'wall', 'points', 'evaluated', 'loaded', 'cached', 'missing', 'points_per_s', 
+            'bytes_per_s', 'hit_ratio' and the per-event totals 'events'. Nothing is timed or recorded if None (default).
+
     returns: np.array(s) with dimensions [*Iterable.args_nd_shape(*pars),*Dict.dict_product_nd_shape(kw)] where pars are the parameter arguments
             passed to the functions(s) and `kw` is the keyword dictionary.
 
     '''
-    def get_callables(*args):
-        '''Get all the functions that were passed'''
-        return [a for a in args if callable(a)]
+    if lazy is not False and instrument is not None and instrument is not False:
+        raise ValueError('instrument cannot be combined with lazy, nothing is evaluated or loaded up front to be instrumented')
+
+    funcs, par0 = _split_args(args)
+
+    if len(funcs) > 1:
+        return [sweep(f, *par0, kw=kw, expand_kw=expand_kw, savepath_prefix=savepath_prefix, extension=extension, overwrite=overwrite, 
+                      pool=pool, pre_process=pre_process, pre_process_kw=pre_process_kw, pass_kw=pass_kw, dry_run=dry_run, print_code=print_code,
+                      inpaint=inpaint, cache=cache, refresh=refresh, verbose=verbose, dtype=dtype, store=store, chunksize=chunksize, reducer=reducer,
+                      point_shape=point_shape, out=out, transport=transport, content_hash=content_hash, deps=deps, 
+                      compression=compression, lazy=lazy, queue=queue, claims=claims, instrument=instrument) for f in funcs]
+
+    collect = None
+    if instrument is not None and instrument is not False:
+        collect = _instrumentation(instrument if callable(instrument) else None)
+
+    if reducer is not None:
+        given = [name for name, value in (('print_code', print_code), ('lazy', lazy is not False), ('dtype', dtype is not None), 
+                                          ('point_shape', point_shape is not None), ('out', out is not None)) if value]
+        if given:
+            raise ValueError(f'reducer cannot be combined with {", ".join(given)}')
+
+        acc, combine = reducer
+        for index, result in sweep_iter(*funcs, *par0, kw=kw, expand_kw=expand_kw, savepath_prefix=savepath_prefix, extension=extension, overwrite=overwrite, 
+                                        pool=pool, pre_process=pre_process, pre_process_kw=pre_process_kw, pass_kw=pass_kw, dry_run=dry_run, inpaint=inpaint, 
+                                        verbose=verbose, store=store, chunksize=chunksize, transport=transport, content_hash=content_hash, deps=deps, compression=compression,
+                                        cache=cache, refresh=refresh, queue=queue, claims=claims, instrument=None if collect is None else lambda e: collect([e])):
+            acc = combine(acc, index, result)
+        return acc if collect is None else (acc, collect.summary())
+
+    plan = _plan(funcs, par0, kw, expand_kw, savepath_prefix, extension, store, content_hash, deps, compression)
+    shape = plan['shape']
+
+    if lazy is not False:
+        return LazySweepArray(plan, pre_process=pre_process, pre_process_kw=pre_process_kw, pass_kw=pass_kw, inpaint=inpaint, 
+                              cache_size=128 if lazy is True else lazy)
+
+    pre_cache = _pre_process_cache(pre_process, store, content_hash) if cache and pre_process is not None else None
+
+    if point_shape is not None or out is not None:
+        results = _typed_results(plan, pool if pool is not None else persistent_pool(), point_shape, dtype, out, overwrite=overwrite, inpaint=inpaint, 
+                                 pre_process=pre_process, pre_process_kw=pre_process_kw, pass_kw=pass_kw, dry_run=dry_run, verbose=verbose, 
+                                 chunksize=chunksize, transport=transport, pre_cache=pre_cache, refresh=refresh, queue=queue, claims=claims, instrument=collect)
+        return results if collect is None else (results, collect.summary())
+
+    results = np.array([[None]*shape[1]]*shape[0])
+
+    code_string = ''
+    if pool is None:
+        pool = persistent_pool()
+        if print_code:
+            code_string = f"from pathos.multiprocessing import ProcessPool\npool = ProcessPool(nodes={pool.nodes})\n"
 
-    def get_iterables(*args):
-        '''Get all the Iterables that were passed'''
-        return [a for a in args if isinstance(a, Iterable)]
+    results_raveled = results.ravel()
 
-    func = get_callables(*args)
-    par0 = get_iterables(*args)
-    params = tuple(product(*par0))
+    to_check = np.arange(len(results_raveled))
+
+    to_run, stream = _dispatch(plan, to_check, pool, overwrite=overwrite, inpaint=inpaint, pre_process=pre_process, pre_process_kw=pre_process_kw,
+                               pass_kw=pass_kw, dry_run=dry_run, verbose=verbose, chunksize=chunksize, transport=transport, pre_cache=pre_cache, 
+                               refresh=refresh, queue=queue, claims=claims, instrument=collect)
+
+    # signal.pthread_sigmask(signal.SIG_BLOCK,[signal.SIGINT])
+
+    inpaint_ij = []
+    for k, result in stream:
+        results_raveled[k] = result
+        if result is None:
+            inpaint_ij.append(k)
+
+    if print_code:
+        func_name = plan['func'].__name__
+        pathos_args_sequence = [f'({pars},{plan["kw"][j]}),' for pars, j in map(plan['point_args'], to_run)]
+        code_string+=f"pool.map(lambda args_and_kws: {func_name}(*args_and_kws[0], **args_and_kws[1]),(\n"+"\n".join(pathos_args_sequence)+"\n))"
+        print(code_string)
+
+    # signal.pthread_sigmask(signal.SIG_UNBLOCK,[signal.SIGINT])
+
+    if inpaint is not None:
+        for k in inpaint_ij:
+            results_raveled[k] = inpaint
+
+    if dtype is None:
+        types=set([type(r) for r in results_raveled])
+        is_scalar = [(not hasattr(r,'shape') ) or r.size==1 for r in results_raveled]
+        if np.all(is_scalar) and _equivalent_classes(types):
+            dtype = first_item(types)
+    
+    try:
+        if dtype is not None:
+            results=np.array(results, dtype = dtype )
+
+        results = results.reshape(*plan['nd_shape'])
+    except (TypeError, ValueError): # results that do not fit the dtype or shape stay a flat object array
+        pass
+    
+    return results if collect is None else (results, collect.summary())
+
+
+def sweep_iter(*args, kw={}, expand_kw=True, savepath_prefix='.', extension='.pickle', overwrite=False, pool=None, 
+                pre_process=None, pre_process_kw={}, pass_kw=False, dry_run=False, inpaint=None, verbose=True, store=FileStore, chunksize=None, 
+                transport='pickle', content_hash=False, deps=(), compression=None, cache=False, refresh=False, queue=None, claims=False, instrument=None):
+    '''
+    Streaming version of `sweep` for a single function, yields `(grid_index, result)` pairs as soon as each result has been loaded or computed.
+
+    Results are produced in order of completion rather than grid order, so callers can start reducing or plotting results right away.
+    Computed results are saved to the `store` as each chunk of grid points finishes, so stopping the iteration early (or an 
+    interrupted run) does not lose any completed work, and a later `sweep` or `sweep_iter` call will simply load those results.
+
+    Args:
+        *args, kw, expand_kw, savepath_prefix, extension, overwrite, pool, pre_process, pre_process_kw, pass_kw, dry_run, inpaint, verbose, store, chunksize, 
+            transport, content_hash, deps, compression, cache, refresh, queue, claims:
+            see `sweep`.
+
+        instrument (callable): Called with every instrumentation event as the results arrive, see `sweep`. Default is None.
+
+    Yields:
+        (grid_index, result): `grid_index` is a tuple of ints indexing into the array that `sweep` would return for the same arguments.
+    '''
+    funcs, par0 = _split_args(args)
+
+    if len(funcs) > 1:
+        raise TypeError('sweep_iter only accepts a single function')
+
+    plan = _plan(funcs, par0, kw, expand_kw, savepath_prefix, extension, store, content_hash, deps, compression)
+
+    if pool is None:
+        pool = persistent_pool()
+
+    to_check = np.arange(np.prod(plan['shape']))
+    pre_cache = _pre_process_cache(pre_process, store, content_hash) if cache and pre_process is not None else None
+
+    _, stream = _dispatch(plan, to_check, pool, overwrite=overwrite, inpaint=inpaint, pre_process=pre_process, pre_process_kw=pre_process_kw,
+                          pass_kw=pass_kw, dry_run=dry_run, verbose=verbose, chunksize=chunksize, transport=transport, pre_cache=pre_cache, refresh=refresh, queue=queue,
+                          claims=claims, instrument=None if instrument is None else _instrumentation(instrument))
+
+    nd_shape = plan['nd_shape']
+    try:
+        for k, result in stream:
+            if result is None and inpaint is not None:
+                result = inpaint
+            yield tuple(int(i) for i in np.unravel_index(k, nd_shape)), result
+    finally:
+        stream.close() # frees the shared memory of results that were never received, if closed early
+
+
+async def sweep_async(*args, **kw):
+    '''
+    `asyncio` version of `sweep_iter`, an asynchronous generator yielding `(grid_index, result)` pairs as results are loaded or computed.
+    Waiting on the next result happens in the event loop's default executor, so the loop is free to run other tasks in the meantime.
+    '''
+    results = sweep_iter(*args, **kw)
+    loop = asyncio.get_running_loop()
+    done = object()
+
+    while True:
+        item = await loop.run_in_executor(None, next, results, done)
+        if item is done:
+            return
+        yield item
+
+
+class LazySweepArray:
+    '''
+    Read-only, ndarray-like view of the stored results of a sweep, with the same shape as the array returned by `sweep` (see its `lazy` keyword).
+
+    Indexing (with ints, slices, index arrays or masks) loads, and pre-processes, only the grid points that are touched, keeping the most 
+    recently used ones in a bounded cache. Results missing from storage are replaced with `inpaint`. `np.asarray` loads everything.
+    '''
+    def __init__(self, plan, pre_process=None, pre_process_kw={}, pass_kw=False, inpaint=None, cache_size=128):
+        self.shape = plan['nd_shape']
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(plan['shape']))
+        self.dtype = np.dtype(object)
+        self.store = plan['store']
+
+        self._plan = plan
+        self._flat = np.arange(self.size).reshape(self.shape)
+        self._pre_process, self._pre_process_kw, self._pass_kw = pre_process, pre_process_kw, pass_kw
+        self._inpaint = inpaint
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f'LazySweepArray({self._plan["func"].__name__}, shape={self.shape}, cached={len(self._cache)})'
+
+    def __getitem__(self, index):
+        flat = self._flat[index]
+        if np.ndim(flat) == 0:
+            return self._get([int(flat)])[0]
+
+        out = np.empty(flat.shape, dtype=object)
+        out_raveled = out.reshape(-1)
+        for i, r in enumerate(self._get(flat.ravel())):
+            out_raveled[i] = r
+
+        return out
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[...]
+        return out if dtype is None else out.astype(dtype)
+
+    def cache_clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _load(self, k):
+        plan = self._plan
+        pars, j = plan['point_args'](k)
+        kw = plan['kw'][j]
+        key = plan['formatter']({**dict(zip(plan['formatter'].args, pars)), **kw})
+
+        try:
+            result = self.store.load(key)
+        except (FileNotFoundError, KeyError):
+            return self._inpaint
+
+        if self._pre_process is not None:
+            result = self._pre_process(result, **({**self._pre_process_kw, **kw} if self._pass_kw else self._pre_process_kw))
+
+        return result
+
+    def _get(self, ks):
+        with self._lock:
+            cached = {k: self._cache[k] for k in ks if k in self._cache}
+            for k in cached:
+                self._cache.move_to_end(k)
+
+        needed = list(dict.fromkeys(k for k in ks if k not in cached))
+        if len(needed) > 1:
+            loaded = persistent_pool(threads=True).map(self._load, needed)
+        else:
+            loaded = [self._load(k) for k in needed]
+
+        with self._lock:
+            for k, r in zip(needed, loaded):
+                cached[k] = r
+                if self._cache_size:
+                    self._cache[k] = r
+                    self._cache.move_to_end(k)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+        return [cached[k] for k in ks]
+
+
+def _split_args(args):
+    '''Get all the functions and all the Iterables that were passed'''
+    funcs = [a for a in args if callable(a)]
 
-    if len(func) > 1:
-        return [sweep(f, params, savepath_prefix=savepath_prefix, extension=extension, overwrite=overwrite, pool=pool, pre_process=pre_process, inpaint=inpaint, cache=cache) for f in func]
-    elif len(func) < 1:
+    if len(funcs) < 1:
         raise TypeError('No function specified')
-    else:
-        func = func[0]
+
+    return funcs, [a for a in args if isinstance(a, Iterable)]
+
+
+def _plan(funcs, par0, kw, expand_kw, savepath_prefix, extension, store, content_hash=False, deps=(), compression=None):
+    '''Sets up the parameter grid and storage of a sweep, returned as a dict'''
+    func = funcs[0]
+    params = tuple(product(*par0))
 
     extension = extension.strip()
     if extension[0] != '.':
         extension = '.'+extension
+
+    store_kw = {}
+    if compression is not None:
+        method, level = (compression, None) if isinstance(compression, str) else compression
+        if method not in Serialization.COMPRESSION or Serialization.COMPRESSION[method] not in Serialization.COMPRESSORS:
+            raise ValueError(f'unavailable compression method {method!r}')
+        extension += Serialization.COMPRESSION[method]
+        if level is not None:
+            store_kw['compression_level'] = level
     kw0=kw
     if isinstance(kw, dict):
         if expand_kw:
@@ -106,201 +436,703 @@ def sweep(*args, kw={}, expand_kw=True, savepath_prefix='.', extension='.pickle'
             kw = [kw]
 
     savepath = function_savedir(func)
+    if content_hash:
+        savepath = os.path.join(savepath, function_hash(func, deps)[:16])
     basedir = os.path.join(savepath_prefix, savepath)
-    results = None
     shape = (max(len(params), 1),  len(kw))
 
-    if cache is not None and pre_process is not None:
-        if cache == True:
-            filename  = hash384(pre_process_kw, pre_hash=hash384([*params, *kw, savepath]))
+    nd_shape = shape
+    if isinstance(kw0, dict) and expand_kw:
+        nd_shape = (*args_nd_shape(*par0),*dict_product_nd_shape(kw0))
+        if np.prod(nd_shape) != np.prod(shape):
+            nd_shape = shape
 
-            cache  = cache_file(pre_process, filename=filename, cache_dir='.cache')
+    def point_args(k):
+        '''positional arguments and keyword dict index of the `k`-th point of the raveled grid'''
+        i, j = np.unravel_index(k, shape)
+
+        pars = params[i] if params else params
 
-            if (not (refresh or overwrite)) and os.path.exists(cache):
-                    with open(cache, 'rb') as file:
-                        results = pickle.load(file)
+        if not isinstance(pars, Iterable):
+            pars = (pars,)
+
+        return pars, j
+
+    return {'func': func, 'par0': par0, 'params': params, 'kw0': kw0, 'kw': kw, 'shape': shape, 'nd_shape': nd_shape, 
+            'savepath': savepath, 'basedir': basedir, 'extension': extension, 'store': store(basedir, extension, **store_kw), 'formatter': signature_formatter(func), 'point_args': point_args}
+
+
+def _pre_process_cache(pre_process, store, content_hash=False):
+    '''store for the per-grid-point cache of pre-processed results, see the `cache` keyword of `sweep`'''
+    basedir = os.path.join('.cache', function_savedir(pre_process))
+    if content_hash:
+        basedir = os.path.join(basedir, function_hash(pre_process)[:16])
+
+    return store(basedir, '.pickle')
+
+
+def _typed_results(plan, pool, point_shape, dtype, out, inpaint=None, **kw):
+    '''Collects the results of a sweep into a preallocated typed array, see the `point_shape` and `out` keywords of `sweep`.'''
+    nd_shape = plan['nd_shape']
+    N = int(np.prod(plan['shape']))
+
+    if isinstance(out, np.ndarray):
+        if out.shape[:len(nd_shape)] != nd_shape:
+            raise ValueError(f'out has shape {out.shape}, but the sweep grid has shape {nd_shape}')
+        point_shape, dtype = out.shape[len(nd_shape):], out.dtype
+    elif isinstance(point_shape, str):
+        point_shape = None # infer from the first result
+
+    def allocate(point_shape, dtype):
+        shape = (*nd_shape, *point_shape)
+        if isinstance(out, str):
+            if os.path.dirname(out):
+                ensure_directory_exists(out)
+            array = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+        elif out is None:
+            array = np.zeros(shape, dtype=dtype)
+        else:
+            array = out
+
+        flat = array.reshape(N, *point_shape)
+        if not np.shares_memory(flat, array):
+            raise ValueError('out must be a contiguous array')
+
+        return array, flat
+
+    array = flat = sink = None
+    if point_shape is not None and dtype is not None:
+        point_shape = tuple(point_shape)
+        array, flat = allocate(point_shape, dtype)
+
+        if isinstance(out, str):
+            def sink(ks, results):
+                '''write results straight into the memory-mapped output from the workers'''
+                mm = np.load(out, mmap_mode='r+')
+                mm_flat = mm.reshape(N, *point_shape)
+                for k, r in zip(ks, results):
+                    mm_flat[k] = r
+                mm.flush()
+
+    _, stream = _dispatch(plan, np.arange(N), pool, inpaint=inpaint, sink=sink, receive_shared=False, **kw)
+
+    missing = []
+    for k, result in stream:
+        if result is _WRITTEN:
+            continue
+        elif result is None:
+            missing.append(k)
+        else:
+            if array is None:
+                if isinstance(result, SharedArray):
+                    array, flat = allocate(result.shape if point_shape is None else point_shape, np.dtype(result.dtype) if dtype is None else dtype)
+                else:
+                    array, flat = allocate(np.shape(result) if point_shape is None else point_shape, np.asarray(result).dtype if dtype is None else dtype)
+
+            if isinstance(result, SharedArray):
+                receive_array(result, out=flat[k]) # straight from shared memory into the output
             else:
-                ensure_directory_exists(cache)
+                flat[k] = result
 
+    if array is None: # nothing to infer the spec from
+        array, flat = allocate(() if point_shape is None else point_shape, float if dtype is None else dtype)
 
+    if inpaint is not None and missing:
+        flat[missing] = inpaint
 
-    if results is None or not (results.shape == shape):
-        results = np.array([[None]*shape[1]]*shape[0])
+    if isinstance(array, np.memmap):
+        array.flush()
 
-    if pool is None:
-        core_count = psutil.cpu_count(logical=False)
-        pool = Pool(nodes=core_count-1)
-        if print_code:
-            code_string = f"from pathos.multiprocessing import ProcessPool\npool = ProcessPool(nodes={core_count-1})\n"
+    return array
 
-      
-    #setup a graceful exit
-    signal.signal(signal.SIGTERM, lambda a,b: pool.terminate())
 
-    results_raveled = results.ravel()
+# arrays smaller than this are cheaper to pickle than to send through shared memory
+_SHM_MIN_BYTES = 1 << 16
 
-    par_names, _ = signature_lists(func)
+def _shared(result):
+    '''`SharedArray` handle for large array results, anything else is returned as is'''
+    if isinstance(result, np.ndarray) and result.nbytes >= _SHM_MIN_BYTES and not result.dtype.hasobject:
+        return share_array(result)
+    return result
 
-    savepaths = multiprocessing.Manager().dict()
-    func_name = func.__name__
+# placeholder result for grid points that the workers wrote directly into the output, Ellipsis is a singleton that survives pickling
+_WRITTEN = Ellipsis
 
-    if print_code:
-        pathos_args_sequence = multiprocessing.Manager().list()
-    
-    def check_filesystem_and_run(k):
+# placeholder result for grid points that have to be checked again, because another process claimed them or their stored result is corrupt
+_RETRY = NotImplemented
 
-        i, j = np.unravel_index(k, shape)
+# seconds to wait between checks on grid points that are claimed by other processes
+_CLAIM_POLL = 1.0
 
-        pars = params[i] if params else params
+def _dispatch(plan, to_check, pool, overwrite=False, inpaint=None, pre_process=None, pre_process_kw={}, pass_kw=False, dry_run=False, verbose=True, chunksize=None,
+              sink=None, transport='pickle', receive_shared=True, pre_cache=None, refresh=False, queue=None, claims=False, instrument=None):
+    '''
+    Evaluate, or load from storage, the grid points `to_check` (indices into the raveled grid of the sweep `plan`).
 
-        if not isinstance(pars, Iterable):
-            pars = (pars,)
-        locals = {**{a: v for a, v in zip(par_names, pars)}, **kw[j]}
+    Returns the indices of the grid points that are to be evaluated, and an iterator over `(index, result)` pairs in order of completion.
+    Grid points that are neither evaluated nor found in storage are yielded with a `None` result. If a `sink(ks, results)` function is given, 
+    the workers hand it their (non-None) results and yield `_WRITTEN` in their place. With `transport='shm'`, large array results are sent
+    back as `SharedArray` handles, which are turned back into arrays unless `receive_shared` is False.
 
-        path = os.path.join(basedir, signature_string( f=func, locals=locals) + extension)
+    If a `pre_cache` store is given, pre-processed results are saved to it as they are produced, and grid points with a pre-processed 
+    result already in it are loaded from there instead (unless `refresh` or `overwrite`).
 
-        savepaths[k] = path
-        missing_file = not os.path.exists(path)
-        run = inpaint is None and (overwrite or missing_file)
+    If a work `queue` (see the `WorkQueue` module) is given, the grid points to be evaluated are shared with any other processes working 
+    on the same queue. Points claimed and evaluated by others are loaded from storage once the queue has been drained.
 
-        if run:
-            if verbose:
-                kw_str=", ".join([ str(k) + "=" + str(v) for k,v in kw[j].items()])
-                pars_str = ", ".join([str(p)  for p in pars])
-                print(f"running: {func_name}({pars_str}, {kw_str})")
-                # print(f"pool.apipe({func_name},{pars_str}, {kw_str})")
+    Otherwise, with `claims` and a store that supports them (see the `Storage` module), every grid point is claimed before it is evaluated, 
+    so that concurrent sweeps over the same grid split the work rather than duplicating it, and points claimed by others are loaded once 
+    their result is stored. Stored results that are truncated or otherwise corrupt (see `Serialization.CORRUPT_ERRORS`) are quarantined and 
+    evaluated again, unless `inpaint` is given, in which case they are left alone and treated as missing.
 
-            if print_code:
-                pathos_args_sequence.append(f'({pars},{kw[j]}),')
+    If an `instrument(events)` function is given (see `_instrumentation`), it is handed the lists of timing events recorded by the workers
+    as their results arrive. Nothing is recorded otherwise.
+    '''
+    if transport not in ('pickle', 'shm'):
+        raise ValueError(f"transport must be 'pickle' or 'shm', not {transport!r}")
 
-            if not dry_run:
-                result = func(*pars, **kw[j])
-            else:
-                result=None
+    if not any(hasattr(pool, method) for method in ('apipe', 'apply_async', 'submit')):
+        raise TypeError(f'cannot submit tasks to a {type(pool).__name__}, the pool needs an apipe, apply_async or submit method')
 
-            #save the result for later, if that makes sense
-            if result is not None and not os.path.exists(path):
-                if  not os.path.exists(basedir):
-                    os.makedirs(basedir)
+    if isinstance(queue, str):
+        queue = SQLiteQueue(queue)
 
-                with open(path, 'wb') as file:
-                    pickle.dump(result, file)
-        else:
-            result = None
+    func, kw, shape, store, point_args = plan['func'], plan['kw'], plan['shape'], plan['store'], plan['point_args']
+    func_name = func.__name__
+    claims = claims and queue is None and not dry_run and hasattr(store, 'claim_many')
+    timed = not dry_run and hasattr(store, 'runtimes')
+    instrumented = instrument is not None # the workers only get to see this flag, not the (possibly unpicklable) instrument itself
 
-        return result
+    #compute every storage key up front, so that existence can be checked in bulk rather than once per grid point
+    pars_and_j = [point_args(k) for k in to_check]
+    savepaths = np.array(plan['formatter'].many([p for p, _ in pars_and_j], [kw[j] for _, j in pars_and_j]), dtype=object)
 
+    def pre_process_kws(j):
+        return {**pre_process_kw, **kw[j]} if pass_kw else pre_process_kw
 
+    #pre-processed results are keyed on the raw result they came from and the keywords they were processed with
+    pre_keys = np.full(len(to_check), None, dtype=object)
+    processed = np.zeros(len(to_check), dtype=bool)
+    if pre_cache is not None:
+        pre_keys[:] = [hash384(pre_process_kws(j), pre_hash=os.path.join(plan['basedir'], key + plan['extension'])) for key, (_, j) in zip(savepaths, pars_and_j)]
+        if not (refresh or overwrite or dry_run):
+            processed = pre_cache.exists(pre_keys)
 
-    to_check = np.where(results_raveled == None)[0]
+    computed = store.exists(savepaths)
 
-    possibly_new_results = len(to_check) > 0
+    if inpaint is None:
+        run = (np.ones(len(to_check), dtype=bool) if overwrite else ~computed) & ~processed
+    else:
+        run = np.zeros(len(to_check), dtype=bool)
 
-    # signal.pthread_sigmask(signal.SIG_BLOCK,[signal.SIGINT])
+    load = ~run & computed & ~processed
 
+    to_run = to_check[run]
+    to_load = to_check[load]
+    to_fetch = to_check[processed]
+    missing = to_check[~run & ~computed & ~processed]
 
-    results_raveled[to_check] = pool.map(check_filesystem_and_run, to_check)
+    def check_filesystem_and_run(k):
 
-    if print_code:
-        code_string+=f"pool.map(lambda args_and_kws: {func_name}(*args_and_kws[0], **args_and_kws[1]),(\n"+"\n".join(pathos_args_sequence)+"\n))"
-        print(code_string)
+        pars, j = point_args(k)
 
+        if verbose:
+            kw_str=", ".join([ str(k) + "=" + str(v) for k,v in kw[j].items()])
+            pars_str = ", ".join([str(p)  for p in pars])
+            print(f"running: {func_name}({pars_str}, {kw_str})")
+            # print(f"pool.apipe({func_name},{pars_str}, {kw_str})")
 
-    # signal.pthread_sigmask(signal.SIG_UNBLOCK,[signal.SIGINT])
+        if not dry_run:
+            result = func(*pars, **kw[j])
+        else:
+            result=None
 
-    inpaint_ij = multiprocessing.Manager().list()
-    kw_pre=pre_process_kw
-    
-    if pass_kw:
-        pre_process_kw0 = pre_process_kw
+        return result
+
+    def run_chunk(ks, keys, missing, pre_keys, submitted=None):
+        '''evaluate a contiguous chunk of grid points as a single task, returns the (index, result) pairs and any instrumentation events'''
+        events = [] if instrumented else None
+        if events is not None and submitted is not None:
+            events.append(_event('queue_wait', ks, time.time() - submitted))
 
-    def loader(k):
-        nonlocal kw_pre # this nonlocal declaration shouldn't be necessary, but fixes a bug in some pyhton 3.10 versions
+        held = np.ones(len(ks), dtype=bool)
+        if claims:
+            held = store.claim_many(keys)
+            if verbose:
+                for key in keys[~held]:
+                    print(f'claimed elsewhere: {store.path(key)}')
+
+        try:
+            results, seconds = [], []
+            for i, k in enumerate(ks):
+                #another process may have stored this since we checked, unless we are overwriting it anyway
+                if claims and held[i] and missing[i] and store.exists(keys[i:i+1])[0]:
+                    store.release(keys[i:i+1])
+                    held[i] = False
+                start = time.perf_counter()
+                results.append(check_filesystem_and_run(k) if held[i] else _RETRY)
+                seconds.append(time.perf_counter() - start)
+
+            #save the results for later, if that makes sense
+            to_save = [(k, key, r) for k, key, r, m, h in zip(ks, keys, results, missing, held) if r is not None and m and h]
+            if events is None:
+                store.save_many([(key, r) for _, key, r in to_save])
+            else:
+                events.extend(_event('compute', [k], t) for k, t, h in zip(ks, seconds, held) if h)
+                if to_save:
+                    timings = {}
+                    store.save_many([(key, r) for _, key, r in to_save], timings=timings)
+                    saved = [k for k, _, _ in to_save]
+                    events.append(_event('serialize', saved, timings.get('serialize', 0)))
+                    events.append(_event('write', saved, timings.get('write', 0), timings.get('bytes', 0)))
+
+            if timed:
+                store.save_runtimes([(key, t) for key, t, h in zip(keys, seconds, held) if h])
+        finally:
+            if claims:
+                store.release(keys[held])
+
+        produced = [h and r is not None for r, h in zip(results, held)]
+
+        if pre_process is not None:
+            if events is None:
+                results = [pre_process(r, **pre_process_kws(point_args(k)[1])) if p else r for k, r, p in zip(ks, results, produced)]
+            else:
+                for i, (k, p) in enumerate(zip(ks, produced)):
+                    if p:
+                        start = time.perf_counter()
+                        results[i] = pre_process(results[i], **pre_process_kws(point_args(k)[1]))
+                        events.append(_event('pre_process', [k], time.perf_counter() - start))
+
+            if pre_cache is not None:
+                pre_cache.save_many([(key, r) for key, r, p in zip(pre_keys, results, produced) if p and r is not None])
+
+        if sink is not None:
+            sink([k for k, r, p in zip(ks, results, produced) if p and r is not None], [r for r, p in zip(results, produced) if p and r is not None])
+            results = [_WRITTEN if p and r is not None else r for r, p in zip(results, produced)]
+        elif transport == 'shm':
+            results = [_shared(r) for r in results]
 
+        return list(zip(ks, results)), events
+
+    def loader(k, key, pre_key):
+        '''load (and pre-process) a stored result, returns the index, result and any instrumentation events'''
         i,j = np.unravel_index(k, shape)
-        if results[i,j] is None:
-            path = savepaths[k]
-            file_exists = os.path.exists(path)
-            if file_exists:  
-                size = os.path.getsize(path)              
-                with open(path, 'rb') as file:
-                    try:
-                        if not dry_run:
-                            if pre_process is None:
-                                out = pickle.load(file)
-                            else:
-                                if pass_kw:
-                                    kw_pre={**pre_process_kw0, **kw[j]}
-
-                                out =  pre_process(pickle.load(file), **kw_pre)
-                        else:
-                            out=None
-
-                        if verbose:
-                            print(f'loaded[{i}][{j}]: {path}  ({size/(1024*1024)} mb)')
-
-                        result =  out
-                    except Exception as e:
-                        
-                        if verbose:
-                            #print(f'exception loading/processing: {path}  ({size/(1024*1024)} mb)')
-                            print(f'rm {path}  ')
-                            print(e)
-                        result = None
-                        raise e
 
+        events = [] if instrumented else None
+        path = store.path(key)
+        sizes = {}
+        if not dry_run:
+            try:
+                size = store.size(key)
+                start = time.perf_counter()
+                out = store.load(key, sizes=sizes)
+            except (FileNotFoundError, KeyError):
+                return k, _RETRY, events # deleted in the meantime
+            except Serialization.CORRUPT_ERRORS as e:
+                #truncated or otherwise corrupt, e.g. written by a process that was killed before writes were made atomic
+                if inpaint is not None: # nothing is evaluated again anyway, so leave it be
+                    if verbose:
+                        print(f'corrupt: {path}  ({type(e).__name__}: {e})')
+                    return k, None, events
+                if verbose:
+                    print(f'mv {path} {path}.corrupt  ({type(e).__name__}: {e})')
+                store.quarantine(key) # rather than deleted, as some errors of intact results look the same
+                return k, _RETRY, events
+
+            if events is not None:
+                events.append(_event('load', [k], time.perf_counter() - start, sizes.get('stored', size)))
+
+            if pre_process is not None:
+                start = time.perf_counter()
+                out =  pre_process(out, **pre_process_kws(j))
+                if events is not None:
+                    events.append(_event('pre_process', [k], time.perf_counter() - start))
+                if pre_cache is not None and out is not None:
+                    pre_cache.save(pre_key, out)
+        else:
+            size = store.size(key)
+            out=None
+
+        if verbose:
+            if sizes.get('raw', size) != size:
+                print(f'loaded[{i}][{j}]: {path}  ({size/(1024*1024)} mb, {sizes["raw"]/(1024*1024)} mb raw)')
             else:
-                # print(f'inpainting[{i}][{j}]:')
-                result = None
+                print(f'loaded[{i}][{j}]: {path}  ({size/(1024*1024)} mb)')
+
+        result =  out
+
+        if transport == 'shm' and pre_process is not None: # only the loads with pre-processing happen in worker processes
+            result = _shared(result)
+
+        return k, result, events
+
+    def fetcher(k, key, pre_key):
+        '''load an already pre-processed result'''
+        sizes = {}
+        try:
+            start = time.perf_counter()
+            result = pre_cache.load(pre_key, sizes=sizes)
+        except (FileNotFoundError, KeyError):
+            return loader(k, key, pre_key) # deleted in the meantime, pre-process the stored result again
+        except Serialization.CORRUPT_ERRORS:
+            if inpaint is None:
+                pre_cache.quarantine(pre_key)
+            return loader(k, key, pre_key)
+        if verbose:
+            i,j = np.unravel_index(k, shape)
+            print(f'loaded[{i}][{j}]: {pre_cache.path(pre_key)}  (pre-processed)')
+        return k, result, [_event('cache_load', [k], time.perf_counter() - start, sizes.get('stored', 0))] if instrumented else None
+
+    run_keys = savepaths[run]
+    run_missing = ~computed[run]
+    run_pre_keys = pre_keys[run]
+
+    #schedule the points expected to take longest first (LPT), so that the stragglers are not left until the end
+    estimates = np.ones(len(to_run))
+    recorded = store.runtimes(run_keys) if timed and len(to_run) else np.full(len(to_run), np.nan)
+    known = not np.isnan(recorded).all()
+    if known:
+        estimates = recorded
+        estimates[np.isnan(estimates)] = np.nanmean(estimates)
+
+        order = np.argsort(-estimates, kind='stable')
+        to_run, run_keys, run_missing, run_pre_keys, estimates = to_run[order], run_keys[order], run_missing[order], run_pre_keys[order], estimates[order]
+
+    if chunksize is None and known:
+        chunks = _balanced_chunks(estimates, 4*_nodes(pool))
+    else:
+        if chunksize is None:
+            chunksize = _auto_chunksize(len(to_run), _nodes(pool))
+        chunks = [slice(c, c+chunksize) for c in range(0, len(to_run), chunksize)]
+
+    if chunksize is None: #for claims from the queue and for re-runs
+        chunksize = max(int(np.median([c.stop - c.start for c in chunks])), 1) if chunks else 1
+
+    expected = dict(zip(to_run, estimates))
+    progress = {'points': 0, 'seconds': 0.0, 'start': time.monotonic()}
+
+    def report(ks):
+        '''print the progress, and the time to completion extrapolated from the expected runtimes of the points done so far'''
+        if not verbose or not len(to_run):
+            return
+        progress['points'] += len(ks)
+        progress['seconds'] += sum(expected.get(k, 0) for k in ks)
+        elapsed = time.monotonic() - progress['start']
+        remaining = estimates.sum() - progress['seconds']
+        eta = elapsed/progress['seconds']*remaining if progress['seconds'] else float('nan')
+        print(f'evaluated {progress["points"]}/{len(to_run)} of {func_name}, ETA {eta:.1f} s')
+
+    #tasks submitted to a pool whose results have not been received yet
+    inflight = []
+
+    load_keys = savepaths[load]
+    load_pre_keys = pre_keys[load]
+    fetch_keys = savepaths[processed]
+    fetch_pre_keys = pre_keys[processed]
+
+    def queued():
+        '''evaluate the grid points in `to_run` through the shared work queue, one claimed chunk per node at a time'''
+        group = hash384(list(savepaths), pre_hash=plan['basedir'] + plan['extension']) #same sweep, same group, on every host
+        index = {key: p for p, key in enumerate(savepaths)}
+        #not stored, so any earlier completion of these does not count. When overwriting, that only holds for the first process of a run
+        queue.put(group, list(run_keys), reset=not overwrite, restart=overwrite)
+
+        pending = {}
+        ran = set()
+        renewed = time.monotonic()
+        while True:
+            while len(pending) < _nodes(pool):
+                keys = queue.claim(group, chunksize)
+                if not keys:
+                    break
+                ps = np.array([index[key] for key in keys])
+                mine = ps[run[ps]]
+                if len(mine) < len(ps): #stored in the meantime, nothing left to do for these
+                    queue.complete(group, list(savepaths[ps[~run[ps]]]))
+                if len(mine):
+                    r = _submit(pool, run_chunk, to_check[mine], savepaths[mine], ~computed[mine], pre_keys[mine], time.time() if instrumented else None)
+                    pending[r] = mine
+                    inflight.append(r)
+
+            if not pending:
+                if not queue.unfinished(group):
+                    break
+                time.sleep(queue.poll) #everything left is leased to others, wait for them to finish (or for their leases to expire)
+                continue
+
+            finished = [r for r in pending if r.ready()]
+            if not finished:
+                if time.monotonic() - renewed > queue.lease/4:
+                    queue.renew(group, [key for ps in pending.values() for key in savepaths[ps]])
+                    renewed = time.monotonic()
+                next(iter(pending)).wait(queue.poll)
+                continue
+
+            for r in finished:
+                ps = pending.pop(r)
+                inflight.remove(r)
+                results = r.get()
+                queue.complete(group, list(savepaths[ps]))
+                ran.update(ps)
+                report(to_check[ps])
+                yield from absorb(results)
+
+        #evaluated by other processes
+        others = np.array([p for p in np.flatnonzero(run) if p not in ran], dtype=int)
+        stored = store.exists(savepaths[others])
+        yield from missed(to_check[others[~stored]])
+        yield from load_windowed(to_check[others[stored]], savepaths[others[stored]], pre_keys[others[stored]])
+
+    def windowed(pool_, func, *arg_lists, stamped=False):
+        '''
+        submit `func` over the argument lists to `pool_` (see `_submit`), with at most a few tasks per node in flight so that results do not pile up in memory 
+        for a slow consumer, returns an iterator over the results in order of completion. The first tasks are submitted right away.
+        If `stamped`, every task gets the time of its submission as an extra last argument (`submitted` of `run_chunk`).
+        '''
+        window = 2*_nodes(pool_)
+        args = zip(*arg_lists)
+        pending = []
+
+        def submit():
+            for a in islice(args, window - len(pending)):
+                pending.append(_submit(pool_, func, *a, *((time.time(),) if stamped else ())))
+                inflight.append(pending[-1])
+
+        def results():
+            while pending:
+                finished = [r for r in pending if r.ready()]
+                if not finished:
+                    pending[0].wait(0.01)
+                    continue
+                for r in finished:
+                    pending.remove(r)
+                submit() #keep the workers busy while the consumer works through these
+                for r in finished:
+                    inflight.remove(r)
+                    yield r.get()
+
+        submit()
+        return results()
+
+    def load_windowed(ks, keys, pre_keys):
+        if not len(ks):
+            return ()
+        load_pool = persistent_pool(threads=True) if pre_process is None else pool #revert to simple if we just have threading for IO-bound stuff
+        return map(receive, windowed(load_pool, loader, ks, keys, pre_keys))
+
+    def settle(retry):
+        '''resolve the grid points that came back as `_RETRY`, until every one of them has a result'''
+        position = {k: p for p, k in enumerate(to_check)}
+
+        while retry:
+            ps = np.array([position[k] for k in retry], dtype=int)
+            retry = []
+
+            stored = store.exists(savepaths[ps])
+            busy = np.zeros(len(ps), dtype=bool)
+            if claims:
+                busy[~stored] = store.claimed(savepaths[ps[~stored]])
+
+            free = ps[~stored & ~busy]
+            running = ()
+            if inpaint is not None or dry_run:
+                yield from missed(to_check[free])
+            elif len(free):
+                chunks = [free[c:c+chunksize] for c in range(0, len(free), chunksize)]
+                running = windowed(pool, run_chunk, [to_check[c] for c in chunks], [savepaths[c] for c in chunks], [np.ones(len(c), dtype=bool) for c in chunks], 
+                                   [pre_keys[c] for c in chunks], stamped=instrumented)
+
+            loaded = ps[stored]
+            for k, result in load_windowed(to_check[loaded], savepaths[loaded], pre_keys[loaded]):
+                if result is _RETRY:
+                    retry.append(k)
+                else:
+                    yield k, result
+
+            for chunk in running:
+                for k, result in absorb(chunk):
+                    if result is _RETRY:
+                        retry.append(k)
+                    else:
+                        yield k, result
+
+            retry.extend(to_check[ps[busy]])
+            if busy.any() and not len(free) and not stored.any(): # nothing to do but wait for the other processes
+                time.sleep(_CLAIM_POLL)
+
+    def stream():
+        try:
+            retry = []
+            for k, result in produce():
+                if result is _RETRY:
+                    retry.append(k)
+                else:
+                    yield k, result
+
+            yield from settle(retry)
+        finally:
+            #closed early or failed, free the shared memory of the results that are still on their way. This waits for the running tasks,
+            #so it happens in the background rather than holding up the caller (e.g., after a KeyboardInterrupt)
+            if transport == 'shm' and inflight:
+                threading.Thread(target=_release_results, args=(list(inflight),), daemon=True).start()
+            inflight.clear()
+
+    def produce():
+        distributed = queue is not None and not dry_run and len(to_run)
+
+        running = ()
+        if chunks and not distributed:
+            running = windowed(pool, run_chunk, [to_run[c] for c in chunks], [run_keys[c] for c in chunks], [run_missing[c] for c in chunks], 
+                               [run_pre_keys[c] for c in chunks], stamped=instrumented)
+
+        yield from missed(missing)
+
+        if len(to_fetch):
+            yield from map(receive, windowed(persistent_pool(threads=True), fetcher, to_fetch, fetch_keys, fetch_pre_keys))
+
+        yield from load_windowed(to_load, load_keys, load_pre_keys)
+
+        for chunk in running:
+            report([k for k, _ in chunk[0]])
+            yield from absorb(chunk)
+
+        if distributed:
+            yield from queued()
+
+    def receive(item):
+        k, result = item[:2]
+        if len(item) > 2 and item[2]:
+            instrument(item[2])
+        if receive_shared and isinstance(result, SharedArray):
+            result = receive_array(result)
+        return k, result
+
+    def absorb(chunk):
+        '''the received (index, result) pairs of a chunk returned by `run_chunk`'''
+        pairs, events = chunk
+        if events:
+            instrument(events)
+        pairs = iter(pairs)
+        try:
+            for pair in pairs:
+                yield receive(pair)
+        finally:
+            for _, result in pairs: # only left over if closed early
+                if isinstance(result, SharedArray):
+                    release_array(result)
+
+    def missed(ks):
+        if instrumented and len(ks):
+            instrument([_event('missing', ks, 0)])
+        for k in ks:
+            yield k, None
+
+    return to_run, stream()
+
+
+def _submit(pool, func, *args):
+    '''
+    submit a single task to a `pathos` pool, a `multiprocessing.Pool` or a `concurrent.futures` executor, 
+    returns a handle with the `ready()`, `wait(timeout)` and `get()` methods of `pathos`/`multiprocessing` async results
+    '''
+    if hasattr(pool, 'apipe'):
+        return pool.apipe(func, *args)
+    if hasattr(pool, 'apply_async'):
+        return pool.apply_async(func, args)
 
-            if result is None:
-                inpaint_ij.append(k)
+    future = pool.submit(func, *args)
 
+    def get():
+        return future.result()
 
-            return result
+    get.get = get
+    get.ready = future.done
+    get.wait = lambda timeout=None: futures_wait([future], timeout)
 
+    return get
 
-  
-      
+def _release_results(results):
+    '''wait for the (run_chunk or loader) tasks behind the `apipe` results, and free the shared memory of any `SharedArray` they returned'''
+    for r in results:
+        try:
+            output = r.get()
+        except Exception:
+            continue
+        pairs = output[0] if isinstance(output[0], list) else [output[:2]]
+        for _, result in pairs:
+            if isinstance(result, SharedArray):
+                release_array(result)
 
-    if pre_process is None:
-        pool = ThreadPool(nodes=psutil.cpu_count()-1) #revert to simple if we just have threading for IO-bound stuff
-        
-    needed = np.where(results_raveled==None)[0] 
 
-    results_raveled[needed] = pool.map(loader, needed) #multiprocessing for CPU-bound stuff
+def _event(name, ks, seconds, nbytes=0):
+    '''instrumentation event, for the grid points `ks` (indices into the raveled grid) of the worker process that recorded it'''
+    return {'event': name, 'points': [int(k) for k in ks], 'seconds': seconds, 'bytes': nbytes, 'pid': os.getpid(), 'time': time.time()}
 
+def _instrumentation(callback=None):
+    '''
+    Collects lists of instrumentation events (see `_dispatch`) into aggregate counters, handing every event to `callback` as well if given.
+    The returned function has a `summary()` method, see the `instrument` keyword of `sweep`.
+    '''
+    totals = {}
+    start = time.perf_counter()
 
-    # results = np.reshape( results, shape)
+    def collect(events):
+        for e in events:
+            t = totals.setdefault(e['event'], {'points': 0, 'seconds': 0.0, 'bytes': 0})
+            t['points'] += len(e['points'])
+            t['seconds'] += e['seconds']
+            t['bytes'] += e['bytes']
+            if callback is not None:
+                callback(e)
 
-    if possibly_new_results and pre_process is not None and cache:
-        with open(cache, 'wb') as file:
-                pickle.dump(results, file)
-    
-    #inpaint after we have cached
-    if inpaint is not None:
-        for k in inpaint_ij:
-            results_raveled[k] = inpaint
+    def summary():
+        wall = time.perf_counter() - start
+        points = {name: totals.get(name, {}).get('points', 0) for name in ('compute', 'load', 'cache_load', 'missing')}
+        total = sum(points.values())
+        moved = sum(totals.get(name, {}).get('bytes', 0) for name in ('write', 'load', 'cache_load'))
 
-    if dtype is None:
-        types=set([type(r) for r in results_raveled])
-        is_scalar = [(not hasattr(r,'shape') ) or r.size==1 for r in results_raveled]
-        if np.all(is_scalar) and _equivalent_classes(types):
-            dtype = first_item(types)
-    
-    try:
-        if dtype is not None:
-            results=np.array(results, dtype = dtype )
+        return {'wall': wall, 'points': total, 'evaluated': points['compute'], 'loaded': points['load'], 'cached': points['cache_load'], 
+                'missing': points['missing'], 'points_per_s': total/wall if wall else float('nan'), 'bytes_per_s': moved/wall if wall else float('nan'),
+                'hit_ratio': (points['load'] + points['cache_load'])/total if total else float('nan'), 'events': {name: dict(t) for name, t in totals.items()}}
 
-        if isinstance(kw0, dict) and expand_kw:
-            results = results.reshape(*[*args_nd_shape(*par0),*dict_product_nd_shape(kw0)])
-    except:
-        pass
-    
-    return results
+    collect.summary = summary
+
+    return collect
 
 
 def _equivalent_classes(types):
     '''checks if the types are all equivalent to the first type (i.e., subclasses of the first type)'''
     types=tuple(types)
-    return np.all([issubclass(t,types[0]) for t in types])
\ No newline at end of file
+    return np.all([issubclass(t,types[0]) for t in types])
+
+
+def _nodes(pool):
+    '''number of workers in a pool, falls back to the number of cpus for pools that do not say'''
+    nodes = getattr(pool, 'nodes', None)
+    if not isinstance(nodes, int) or nodes < 1:
+        nodes = os.cpu_count() or 1
+
+    return nodes
+
+def _auto_chunksize(n, nodes):
+    '''chunk size that splits `n` tasks into about four chunks per node, same heuristic as `multiprocessing.Pool.map`'''
+    chunksize, extra = divmod(n, 4*nodes)
+    if extra:
+        chunksize += 1
+
+    return max(chunksize, 1)
+
+def _balanced_chunks(estimates, n):
+    '''split points, sorted by decreasing expected runtime, into contiguous chunks of about `sum(estimates)/n` seconds each'''
+    target = estimates.sum()/n
+    chunks, start, total = [], 0, 0.0
+    for i, t in enumerate(estimates):
+        total += t
+        if total >= target:
+            chunks.append(slice(start, i+1))
+            start, total = i+1, 0.0
+    if start < len(estimates):
+        chunks.append(slice(start, len(estimates)))
+
+    return chunks
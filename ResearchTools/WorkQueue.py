@@ -0,0 +1,87 @@
+'''
+Work queues shared by several processes, possibly on different hosts, so that they can split the grid points of a sweep between them.
+Primarily intended for use by the Sweep module (see the `queue` keyword of `Sweep.sweep`).
+
+A queue is a closure that claims tasks. Tasks are string keys that belong to a named group (e.g., one group per sweep):
+    - `put(group, keys, reset=False, restart=False)`: add tasks to the group, keys that are already queued are left as they are. 
+        Tasks that are done are queued again if `reset`, e.g. because their results went missing. With `restart` they are only queued again
+        if the group has no unfinished tasks, i.e., when starting a new run over the group rather than joining one that is under way.
+    - `claim(group, n)`: claim up to `n` of the group's unfinished tasks that are not leased to another owner, returns their keys.
+        Calling the queue itself is the same as calling `claim`.
+    - `renew(group, keys)`: extend the leases on tasks claimed by this process.
+    - `complete(group, keys)`: mark claimed tasks as done.
+    - `unfinished(group)`: number of tasks in the group that are not done yet.
+
+Every claim comes with a lease of `lease` seconds. If the owner neither completes nor renews the task in that time (e.g., because it crashed),
+the task is up for grabs again.
+'''
+
+import os, socket, time
+
+from .Filesystem import sqlite_connect
+
+
+_SCHEMA = ('''CREATE TABLE IF NOT EXISTS tasks (grp TEXT NOT NULL, key TEXT NOT NULL, owner TEXT, expires REAL NOT NULL DEFAULT 0,
+              done INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (grp, key))''',)
+
+def _connect(db):
+    return sqlite_connect(db, _SCHEMA)
+
+
+def SQLiteQueue(path, lease=3600, poll=1.0):
+    '''
+    Work queue kept in a SQLite file at `path`, which must be on a filesystem shared by all participating processes (and support file locking).
+
+    Claims happen in exclusive transactions, so every task is claimed by exactly one process at a time. `lease` is the number of seconds
+    a claim lasts without being renewed, and `poll` the number of seconds waited between checks on tasks that are leased to others.
+    Completed tasks stay in the file, so a later run with the same group only works on the tasks that were never completed (unless they are put again 
+    with `reset`); delete the file to start over.
+    '''
+    owner = f'{socket.gethostname()}:{os.getpid()}'
+
+    def put(group, keys, reset=False, restart=False):
+        conn = _connect(path)
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if restart: #processes that join a run later must not redo what the others already did
+                reset = reset or not conn.execute('SELECT EXISTS (SELECT 1 FROM tasks WHERE grp=? AND done=0)', (group,)).fetchone()[0]
+            conn.executemany('INSERT OR IGNORE INTO tasks (grp, key) VALUES (?, ?)', [(group, key) for key in keys])
+            if reset: #tasks that are leased (i.e., running) are left to their owner
+                conn.executemany('UPDATE tasks SET done=0, owner=NULL, expires=0 WHERE grp=? AND key=? AND done=1', [(group, key) for key in keys])
+
+    def claim(group, n=1):
+        conn = _connect(path)
+        now = time.time()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            keys = [r[0] for r in conn.execute('SELECT key FROM tasks WHERE grp=? AND done=0 AND expires<? ORDER BY rowid LIMIT ?', (group, now, n))]
+            conn.executemany('UPDATE tasks SET owner=?, expires=? WHERE grp=? AND key=?', [(owner, now + lease, group, key) for key in keys])
+        return keys
+
+    def renew(group, keys):
+        conn = _connect(path)
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('UPDATE tasks SET expires=? WHERE grp=? AND key=? AND owner=?', [(time.time() + lease, group, key, owner) for key in keys])
+
+    def complete(group, keys):
+        conn = _connect(path)
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('UPDATE tasks SET done=1, owner=? WHERE grp=? AND key=?', [(owner, group, key) for key in keys])
+
+    def unfinished(group):
+        return _connect(path).execute('SELECT COUNT(*) FROM tasks WHERE grp=? AND done=0', (group,)).fetchone()[0]
+
+    out = claim
+    out.put = put
+    out.claim = claim
+    out.renew = renew
+    out.complete = complete
+    out.unfinished = unfinished
+    out.path = path
+    out.owner = owner
+    out.lease = lease
+    out.poll = poll
+
+    return out